@@ -2,6 +2,9 @@
 # -*- encoding: utf-8 -*-
 #vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
 
+import json
+from urllib.parse import urlparse
+
 import aws_cdk as core
 
 from aws_cdk import (
@@ -11,7 +14,9 @@ from aws_cdk import (
   aws_ec2,
   aws_events,
   aws_events_targets,
+  aws_glue,
   aws_iam,
+  aws_kinesisfirehose,
   aws_lambda as _lambda,
   aws_logs,
   aws_s3 as s3
@@ -91,8 +96,120 @@ class AwsAthenaCqrsPatternsStack(Stack):
       projection_type=dynamodb.ProjectionType.KEYS_ONLY
     )
 
+    # Query History
+    #XXX: Completion records are buffered by Kinesis Data Firehose and
+    # written to S3 in micro-batches of gzip compressed JSON lines.
+    query_history_firehose_role = aws_iam.Role(self, "QueryHistoryFirehoseRole",
+      assumed_by=aws_iam.ServicePrincipal("firehose.amazonaws.com")
+    )
+
+    query_history_firehose_role.add_to_policy(aws_iam.PolicyStatement(
+      effect=aws_iam.Effect.ALLOW,
+      resources=[s3_bucket.bucket_arn, "{}/*".format(s3_bucket.bucket_arn)],
+      actions=["s3:AbortMultipartUpload",
+        "s3:GetBucketLocation",
+        "s3:GetObject",
+        "s3:ListBucket",
+        "s3:ListBucketMultipartUploads",
+        "s3:PutObject"
+      ]))
+
+    query_history_delivery_stream = aws_kinesisfirehose.CfnDeliveryStream(self, "QueryHistoryDeliveryStream",
+      delivery_stream_name="AthenaQueryHistory",
+      delivery_stream_type="DirectPut",
+      extended_s3_destination_configuration=aws_kinesisfirehose.CfnDeliveryStream.ExtendedS3DestinationConfigurationProperty(
+        bucket_arn=s3_bucket.bucket_arn,
+        role_arn=query_history_firehose_role.role_arn,
+        buffering_hints=aws_kinesisfirehose.CfnDeliveryStream.BufferingHintsProperty(
+          interval_in_seconds=300,
+          size_in_m_bs=64
+        ),
+        compression_format="GZIP",
+        prefix="query-history/dt=!{timestamp:yyyy-MM-dd}/",
+        error_output_prefix="query-history-error/!{firehose:error-output-type}/dt=!{timestamp:yyyy-MM-dd}/"
+      )
+    )
+    query_history_delivery_stream.node.add_dependency(query_history_firehose_role)
+
+    #XXX: Partition projection makes new `dt` partitions queryable without MSCK REPAIR TABLE.
+    query_history_database = aws_glue.CfnDatabase(self, "QueryHistoryDatabase",
+      catalog_id=core.Aws.ACCOUNT_ID,
+      database_input=aws_glue.CfnDatabase.DatabaseInputProperty(
+        name="athena_cqrs_history"
+      )
+    )
+
+    query_history_location = "s3://{}/query-history/".format(s3_bucket.bucket_name)
+    query_history_columns = [
+      ("query_id", "string"),
+      ("user_id", "string"),
+      ("work_group", "string"),
+      ("database", "string"),
+      ("statement_type", "string"),
+      ("query_state", "string"),
+      ("state_change_reason", "string"),
+      ("submitted_at", "bigint"),
+      ("completed_at", "bigint"),
+      ("queue_time_ms", "bigint"),
+      ("planning_time_ms", "bigint"),
+      ("engine_execution_time_ms", "bigint"),
+      ("service_processing_time_ms", "bigint"),
+      ("total_execution_time_ms", "bigint"),
+      ("data_scanned_bytes", "bigint"),
+      ("output_location", "string")
+    ]
+
+    query_history_table = aws_glue.CfnTable(self, "QueryHistoryTable",
+      catalog_id=core.Aws.ACCOUNT_ID,
+      database_name="athena_cqrs_history",
+      table_input=aws_glue.CfnTable.TableInputProperty(
+        name="query_history",
+        table_type="EXTERNAL_TABLE",
+        parameters={
+          "classification": "json",
+          "compressionType": "gzip",
+          "projection.enabled": "true",
+          "projection.dt.type": "date",
+          "projection.dt.format": "yyyy-MM-dd",
+          "projection.dt.range": "2020-01-01,NOW",
+          "projection.dt.interval": "1",
+          "projection.dt.interval.unit": "DAYS",
+          "storage.location.template": "{}dt=${{dt}}/".format(query_history_location)
+        },
+        partition_keys=[aws_glue.CfnTable.ColumnProperty(name="dt", type="string")],
+        storage_descriptor=aws_glue.CfnTable.StorageDescriptorProperty(
+          columns=[aws_glue.CfnTable.ColumnProperty(name=name, type=col_type)
+            for name, col_type in query_history_columns],
+          location=query_history_location,
+          input_format="org.apache.hadoop.mapred.TextInputFormat",
+          output_format="org.apache.hadoop.hive.ql.io.HiveIgnoreKeyTextOutputFormat",
+          compressed=True,
+          serde_info=aws_glue.CfnTable.SerdeInfoProperty(
+            serialization_library="org.openx.data.jsonserde.JsonSerDe"
+          )
+        )
+      )
+    )
+    query_history_table.add_dependency(query_history_database)
+
+    query_history_put_policy_statement = aws_iam.PolicyStatement(
+      effect=aws_iam.Effect.ALLOW,
+      resources=[query_history_delivery_stream.attr_arn],
+      actions=["firehose:PutRecord",
+        "firehose:PutRecordBatch"
+      ]
+    )
+
     athena_work_group = self.node.try_get_context("athena_work_group_name")
 
+    #XXX: aws_backends module shared by every Lambda function
+    common_lambda_layer = _lambda.LayerVersion(self, "CommonLambdaLayer",
+      layer_version_name="athena-cqrs-common",
+      code=_lambda.Code.from_asset("./src/main/python/CommonLayer"),
+      compatible_runtimes=[_lambda.Runtime.PYTHON_3_7],
+      description="aws backend abstraction for the athena cqrs lambda functions"
+    )
+
     # Query CommandHandler
     EMAIL_FROM_ADDRESS = self.node.try_get_context('email_from_address')
     query_executor_lambda_fn = _lambda.Function(self, "CommandHander",
@@ -101,6 +218,7 @@ class AwsAthenaCqrsPatternsStack(Stack):
       handler="command_handler.lambda_handler",
       description="athena query executor",
       code=_lambda.Code.from_asset("./src/main/python/CommandHander"),
+      layers=[common_lambda_layer],
       environment={
         #TODO: MUST set appropriate environment variables for your workloads.
         'AWS_REGION_NAME': core.Aws.REGION,
@@ -164,6 +282,44 @@ class AwsAthenaCqrsPatternsStack(Stack):
       deploy_options=apigateway.StageOptions(stage_name="v1")
     )
 
+    #XXX: Optional delivery of query results to per-user or per-team locations.
+    # For example, pass the following context to cdk command
+    #   "results_delivery_targets": {
+    #     "xyz@example.com": "s3://xyz-bucket/athena-results/",
+    #     "@example.com": "s3://example-team-bucket/athena-results/"
+    #   },
+    #   "results_delivery_mode": "copy"
+    results_delivery_targets = self.node.try_get_context('results_delivery_targets') or {}
+    results_delivery_mode = self.node.try_get_context('results_delivery_mode') or 'copy'
+    results_delivery_environment = {
+      'RESULTS_DELIVERY_TARGETS': json.dumps(results_delivery_targets),
+      'RESULTS_DELIVERY_MODE': results_delivery_mode,
+      'RESULTS_DELIVERY_PART_SIZE_MB': '128',
+      'RESULTS_DELIVERY_MAX_WORKERS': '8'
+    }
+
+    # The multipart copy checkpoints its progress next to the query results.
+    results_delivery_policy_statements = [aws_iam.PolicyStatement(
+      effect=aws_iam.Effect.ALLOW,
+      resources=["{}/*".format(s3_bucket.bucket_arn)],
+      actions=["s3:PutObject",
+        "s3:DeleteObject"
+      ])]
+
+    results_delivery_bucket_names = sorted(set(urlparse(location, scheme='s3').netloc
+      for location in results_delivery_targets.values()))
+    if results_delivery_bucket_names:
+      results_delivery_bucket_arns = ['arn:{}:s3:::{}'.format(core.Aws.PARTITION, bucket_name)
+        for bucket_name in results_delivery_bucket_names]
+      results_delivery_policy_statements.append(aws_iam.PolicyStatement(
+        effect=aws_iam.Effect.ALLOW,
+        resources=results_delivery_bucket_arns + ['{}/*'.format(arn) for arn in results_delivery_bucket_arns],
+        actions=["s3:GetObject",
+          "s3:PutObject",
+          "s3:AbortMultipartUpload",
+          "s3:ListMultipartUploadParts"
+        ]))
+
     # QueryResultsHandler
     query_results_lambda_fn = _lambda.Function(self, "QueryResultsHandler",
       runtime=_lambda.Runtime.PYTHON_3_7,
@@ -171,11 +327,15 @@ class AwsAthenaCqrsPatternsStack(Stack):
       handler="query_results_handler.lambda_handler",
       description="athena query results handler",
       code=_lambda.Code.from_asset("./src/main/python/QueryResultsHandler"),
+      layers=[common_lambda_layer],
       environment={
         #TODO: MUST set appropriate environment variables for your workloads.
         'AWS_REGION_NAME': core.Aws.REGION,
         'DOWNLOAD_URL_TTL': '3600',
-        'DDB_TABLE_NAME': ddb_table.table_name
+        'DDB_TABLE_NAME': ddb_table.table_name,
+        'QUERY_HISTORY_DELIVERY_STREAM_NAME': query_history_delivery_stream.ref,
+        'CLAIM_TIMEOUT_MINUTES': '30',
+        **results_delivery_environment
       },
       timeout=core.Duration.minutes(5)
     )
@@ -190,6 +350,9 @@ class AwsAthenaCqrsPatternsStack(Stack):
       ]))
 
     query_results_lambda_fn.add_to_role_policy(ddb_table_rw_policy_statement)
+    query_results_lambda_fn.add_to_role_policy(query_history_put_policy_statement)
+    for policy_statement in results_delivery_policy_statements:
+      query_results_lambda_fn.add_to_role_policy(policy_statement)
 
     log_group = aws_logs.LogGroup(self, "QueryResultsHandlerLogGroup",
       log_group_name="/aws/lambda/QueryResultsHandler",
@@ -232,3 +395,64 @@ class AwsAthenaCqrsPatternsStack(Stack):
       rule_name='AthenaQueryExecutionRule',
       targets=[lambda_fn_target]
     )
+
+    # QueryStatusSweeper
+    #XXX: Reconciles tracking rows whose Athena Query State Change events were lost,
+    # so it shares the code and the completion path of the QueryResultsHandler.
+    query_status_sweeper_lambda_fn = _lambda.Function(self, "QueryStatusSweeper",
+      runtime=_lambda.Runtime.PYTHON_3_7,
+      function_name="QueryStatusSweeper",
+      handler="query_status_sweeper.lambda_handler",
+      description="athena query status sweeper",
+      code=_lambda.Code.from_asset("./src/main/python/QueryResultsHandler"),
+      layers=[common_lambda_layer],
+      environment={
+        #TODO: MUST set appropriate environment variables for your workloads.
+        'AWS_REGION_NAME': core.Aws.REGION,
+        'DOWNLOAD_URL_TTL': '3600',
+        'DDB_TABLE_NAME': ddb_table.table_name,
+        'EMAIL_FROM_ADDRESS': EMAIL_FROM_ADDRESS,
+        'QUERY_HISTORY_DELIVERY_STREAM_NAME': query_history_delivery_stream.ref,
+        **results_delivery_environment,
+        'STALE_QUERY_MINUTES': '30',
+        'SCAN_TOTAL_SEGMENTS': '4',
+        'CLAIM_TIMEOUT_MINUTES': '30'
+      },
+      timeout=core.Duration.minutes(5)
+    )
+
+    query_status_sweeper_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
+      effect=aws_iam.Effect.ALLOW,
+      resources=["*"],
+      actions=["athena:BatchGetQueryExecution",
+        "athena:GetQueryExecution"
+      ]))
+
+    query_status_sweeper_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
+      effect=aws_iam.Effect.ALLOW,
+      resources=[s3_bucket.bucket_arn, "{}/*".format(s3_bucket.bucket_arn)],
+      actions=["s3:Get*",
+        "s3:List*"
+      ]))
+
+    query_status_sweeper_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
+      effect=aws_iam.Effect.ALLOW,
+      resources=["*"],
+      actions=["ses:SendEmail"]))
+
+    query_status_sweeper_lambda_fn.add_to_role_policy(ddb_table_rw_policy_statement)
+    query_status_sweeper_lambda_fn.add_to_role_policy(query_history_put_policy_statement)
+    for policy_statement in results_delivery_policy_statements:
+      query_status_sweeper_lambda_fn.add_to_role_policy(policy_statement)
+
+    sweeper_log_group = aws_logs.LogGroup(self, "QueryStatusSweeperLogGroup",
+      log_group_name="/aws/lambda/QueryStatusSweeper",
+      retention=aws_logs.RetentionDays.THREE_DAYS)
+    sweeper_log_group.grant_write(query_status_sweeper_lambda_fn)
+
+    sweeper_schedule_rule = aws_events.Rule(self, "AthenaQueryStatusSweeperRule",
+      schedule=aws_events.Schedule.rate(core.Duration.minutes(15)),
+      description='Reconcile stale Athena query status',
+      rule_name='AthenaQueryStatusSweeperRule',
+      targets=[aws_events_targets.LambdaFunction(query_status_sweeper_lambda_fn)]
+    )
@@ -10,7 +10,9 @@ import math
 import datetime
 from urllib.parse import urlparse
 
-import boto3
+import aws_backends
+
+import request_validator
 
 LOGGER = logging.getLogger()
 if len(LOGGER.handlers) > 0:
@@ -30,7 +32,7 @@ DDB_TABLE_NAME = os.getenv('DDB_TABLE_NAME')
 def lambda_handler(event, context):
   LOGGER.info(event)
 
-  http_method = event['httpMethod']
+  http_method = event.get('httpMethod')
   if http_method != 'POST':
     response = {
       'statusCode': 405,
@@ -39,7 +41,16 @@ def lambda_handler(event, context):
     }
     return response
 
-  query = json.loads(event['body'])
+  try:
+    query, req_user_id = request_validator.validate_request(event)
+  except request_validator.ValidationError as ex:
+    response = {
+      'statusCode': ex.status_code,
+      'body': json.dumps({'error': str(ex)}),
+      'isBase64Encoded': False
+    }
+    return response
+
   query_output_location = query['ResultConfiguration']['OutputLocation']
   url_parse_result = urlparse(query_output_location, scheme='s3')
   s3_bucket_name = url_parse_result.netloc
@@ -60,18 +71,15 @@ def lambda_handler(event, context):
     }
     return response
 
-  req_user_id = event['queryStringParameters']['user']
-
-  athena_client = boto3.client('athena', region_name=AWS_REGION_NAME)
+  athena_client = aws_backends.get_backend().athena(AWS_REGION_NAME)
   try:
     response = athena_client.start_query_execution(**query)
     query_execution_id = response['QueryExecutionId']
     LOGGER.info('QueryExecutionId: %s' % query_execution_id)
 
-    dynamodb = boto3.resource('dynamodb', region_name=AWS_REGION_NAME)
-    ddb_table = dynamodb.Table(DDB_TABLE_NAME)
+    ddb_table = aws_backends.get_backend().dynamodb_table(DDB_TABLE_NAME, AWS_REGION_NAME)
 
-    expired_date = datetime.datetime.utcnow() + datetime.timedelta(days=7)
+    expired_date = aws_backends.get_backend().utcnow() + datetime.timedelta(days=7)
     #TODO: should handle ProvisionedThroughputExceededException
     ddb_table.put_item(Item={
       'user_id': req_user_id,
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+#vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import os
+import re
+import json
+import base64
+import binascii
+
+MAX_BODY_BYTES = int(os.getenv('MAX_BODY_BYTES', str(512 * 1024)))
+#XXX: Athena rejects query strings longer than 262144 bytes.
+MAX_QUERY_STRING_BYTES = int(os.getenv('MAX_QUERY_STRING_BYTES', '262144'))
+
+
+class ValidationError(ValueError):
+
+  def __init__(self, path, message, status_code=400):
+    super().__init__('{}: {}'.format(path, message) if path else message)
+    self.path = path
+    self.status_code = status_code
+
+
+#XXX: The subset of JSON Schema used by this module is
+# type, properties, required, additionalProperties, enum, pattern,
+# minLength, maxLength, maxBytes(utf-8 encoded length), minimum, maximum, items and minItems.
+# A pattern is searched like in JSON Schema, so it is anchored with `\Z`;
+# `$` also matches before a trailing newline.
+_TYPE_CHECKS = {
+  'object': lambda v: isinstance(v, dict),
+  'array': lambda v: isinstance(v, list),
+  'string': lambda v: isinstance(v, str),
+  'integer': lambda v: isinstance(v, int) and not isinstance(v, bool),
+  'boolean': lambda v: isinstance(v, bool)
+}
+
+
+def _join_path(path, name):
+  return '{}.{}'.format(path, name) if path else name
+
+
+def compile_schema(schema):
+  '''Compile a schema into a validator function.
+
+  The schema is walked once, and the returned function `validate(value, path='')`
+  only runs the checks the schema asks for. It raises `ValidationError` with the
+  path of the first invalid field.
+  '''
+  checks = []
+
+  schema_type = schema.get('type')
+  if schema_type:
+    is_type = _TYPE_CHECKS[schema_type]
+    type_message = 'must be {}'.format(schema_type)
+    def _check_type(value, path):
+      if not is_type(value):
+        raise ValidationError(path, type_message)
+    checks.append(_check_type)
+
+  if 'enum' in schema:
+    choices = frozenset(schema['enum'])
+    enum_message = 'must be one of {}'.format(', '.join(sorted(choices)))
+    def _check_enum(value, path):
+      if value not in choices:
+        raise ValidationError(path, enum_message)
+    checks.append(_check_enum)
+
+  if 'minLength' in schema or 'maxLength' in schema:
+    min_length, max_length = schema.get('minLength', 0), schema.get('maxLength')
+    def _check_length(value, path):
+      if len(value) < min_length:
+        raise ValidationError(path, 'must be at least {} characters'.format(min_length))
+      if max_length is not None and len(value) > max_length:
+        raise ValidationError(path, 'must be at most {} characters'.format(max_length))
+    checks.append(_check_length)
+
+  if 'maxBytes' in schema:
+    max_bytes = schema['maxBytes']
+    def _check_bytes(value, path):
+      #XXX: A utf-8 character is at most 4 bytes, so most strings skip the encoding.
+      if len(value) * 4 > max_bytes and len(value.encode('utf-8')) > max_bytes:
+        raise ValidationError(path, 'must be at most {} bytes'.format(max_bytes), status_code=413)
+    checks.append(_check_bytes)
+
+  if 'pattern' in schema:
+    regex = re.compile(schema['pattern'])
+    pattern_message = 'must match {}'.format(schema['pattern'])
+    def _check_pattern(value, path):
+      if not regex.search(value):
+        raise ValidationError(path, pattern_message)
+    checks.append(_check_pattern)
+
+  if 'minimum' in schema or 'maximum' in schema:
+    minimum, maximum = schema.get('minimum'), schema.get('maximum')
+    def _check_range(value, path):
+      if minimum is not None and value < minimum:
+        raise ValidationError(path, 'must be >= {}'.format(minimum))
+      if maximum is not None and value > maximum:
+        raise ValidationError(path, 'must be <= {}'.format(maximum))
+    checks.append(_check_range)
+
+  if 'items' in schema or 'minItems' in schema:
+    validate_item = compile_schema(schema['items']) if 'items' in schema else None
+    min_items = schema.get('minItems', 0)
+    def _check_items(value, path):
+      if len(value) < min_items:
+        raise ValidationError(path, 'must have at least {} items'.format(min_items))
+      if validate_item:
+        for i, item in enumerate(value):
+          validate_item(item, '{}[{}]'.format(path, i))
+    checks.append(_check_items)
+
+  if 'properties' in schema or 'required' in schema:
+    properties = {name: compile_schema(prop_schema)
+      for name, prop_schema in schema.get('properties', {}).items()}
+    required = tuple(schema.get('required', ()))
+    additional_properties = schema.get('additionalProperties', True)
+    def _check_properties(value, path):
+      for name in required:
+        if value.get(name) is None:
+          raise ValidationError(_join_path(path, name), 'is required')
+      for name, prop_value in value.items():
+        validate_prop = properties.get(name)
+        if validate_prop:
+          validate_prop(prop_value, _join_path(path, name))
+        elif not additional_properties:
+          raise ValidationError(_join_path(path, name), 'is not allowed')
+    checks.append(_check_properties)
+
+  checks = tuple(checks)
+  def validate(value, path=''):
+    for check in checks:
+      check(value, path)
+    return value
+  return validate
+
+
+#XXX: API Gateway Lambda proxy integration event
+# https://docs.aws.amazon.com/apigateway/latest/developerguide/set-up-lambda-proxy-integrations.html
+EVENT_SCHEMA = {
+  'type': 'object',
+  'required': ['body', 'queryStringParameters'],
+  'properties': {
+    'httpMethod': {'type': 'string'},
+    'body': {'type': 'string', 'minLength': 1},
+    'isBase64Encoded': {'type': 'boolean'},
+    'queryStringParameters': {
+      'type': 'object',
+      'required': ['user'],
+      'properties': {
+        'user': {'type': 'string', 'maxLength': 254, 'pattern': r'^[^@\s]+@[^@\s]+\.[^@\s]+\Z'}
+      }
+    }
+  }
+}
+
+#XXX: Request syntax of Athena StartQueryExecution API
+# https://docs.aws.amazon.com/athena/latest/APIReference/API_StartQueryExecution.html
+# Unknown keys are rejected because the body is passed to `start_query_execution` as is.
+START_QUERY_EXECUTION_SCHEMA = {
+  'type': 'object',
+  'additionalProperties': False,
+  'required': ['QueryString', 'ResultConfiguration'],
+  'properties': {
+    'QueryString': {'type': 'string', 'minLength': 1, 'maxBytes': MAX_QUERY_STRING_BYTES},
+    'ClientRequestToken': {'type': 'string', 'minLength': 32, 'maxLength': 128},
+    'QueryExecutionContext': {
+      'type': 'object',
+      'additionalProperties': False,
+      'properties': {
+        'Database': {'type': 'string', 'minLength': 1, 'maxLength': 255},
+        'Catalog': {'type': 'string', 'minLength': 1, 'maxLength': 256}
+      }
+    },
+    'ResultConfiguration': {
+      'type': 'object',
+      'additionalProperties': False,
+      'required': ['OutputLocation'],
+      'properties': {
+        'OutputLocation': {'type': 'string', 'maxLength': 1024, 'pattern': r'^s3://[^/]+'},
+        'EncryptionConfiguration': {
+          'type': 'object',
+          'additionalProperties': False,
+          'required': ['EncryptionOption'],
+          'properties': {
+            'EncryptionOption': {'type': 'string', 'enum': ['SSE_S3', 'SSE_KMS', 'CSE_KMS']},
+            'KmsKey': {'type': 'string', 'minLength': 1}
+          }
+        },
+        'ExpectedBucketOwner': {'type': 'string', 'pattern': r'^[0-9]{12}\Z'},
+        'AclConfiguration': {
+          'type': 'object',
+          'additionalProperties': False,
+          'required': ['S3AclOption'],
+          'properties': {
+            'S3AclOption': {'type': 'string', 'enum': ['BUCKET_OWNER_FULL_CONTROL']}
+          }
+        }
+      }
+    },
+    'WorkGroup': {'type': 'string', 'minLength': 1, 'maxLength': 128},
+    'ExecutionParameters': {
+      'type': 'array',
+      'minItems': 1,
+      'items': {'type': 'string', 'minLength': 1, 'maxLength': 1024}
+    },
+    'ResultReuseConfiguration': {
+      'type': 'object',
+      'additionalProperties': False,
+      'properties': {
+        'ResultReuseByAgeConfiguration': {
+          'type': 'object',
+          'additionalProperties': False,
+          'required': ['Enabled'],
+          'properties': {
+            'Enabled': {'type': 'boolean'},
+            'MaxAgeInMinutes': {'type': 'integer', 'minimum': 0, 'maximum': 10080}
+          }
+        }
+      }
+    }
+  }
+}
+
+# Compiled once per Lambda container
+validate_event = compile_schema(EVENT_SCHEMA)
+validate_start_query_execution = compile_schema(START_QUERY_EXECUTION_SCHEMA)
+
+
+def validate_request(event):
+  '''Validate an API Gateway event and return `(query, user_id)`.
+
+  Raises `ValidationError` whose `status_code` is 400, or 413 for a body or
+  query string over the size limit.
+  '''
+  validate_event(event)
+
+  body = event['body']
+  #XXX: A utf-8 character is at most 4 bytes, so most bodies skip the encoding.
+  if len(body) * 4 > MAX_BODY_BYTES and len(body.encode('utf-8')) > MAX_BODY_BYTES:
+    raise ValidationError('body', 'must be at most {} bytes'.format(MAX_BODY_BYTES), status_code=413)
+
+  if event.get('isBase64Encoded'):
+    try:
+      body = base64.b64decode(body, validate=True)
+    except (binascii.Error, ValueError):
+      raise ValidationError('body', 'invalid base64 encoding')
+
+  try:
+    query = json.loads(body)
+  except ValueError:
+    raise ValidationError('body', 'invalid json')
+  except RecursionError:
+    #XXX: Deeply nested arrays or objects exhaust the recursion limit of the json decoder.
+    raise ValidationError('body', 'too deeply nested json')
+
+  validate_start_query_execution(query, 'body')
+  return query, event['queryStringParameters']['user']
+
+
+if __name__ == '__main__':
+  import argparse
+  import timeit
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--number', type=int, default=100000,
+    help='number of validations per benchmark: default=100000')
+
+  options = parser.parse_args()
+
+  req_body = {
+    "QueryString": "SELECT dt, impressionid FROM impressions WHERE dt < '2009-04-12-14-00' AND dt >= '2009-04-12-13-00' ORDER BY dt DESC LIMIT 100",
+    "QueryExecutionContext": {
+      "Database": "hive_ads"
+    },
+    "ResultConfiguration": {
+      "OutputLocation": "s3://aws-athena-cqrs-workspace-us-east-1-v89ca8y9vj/query-results/"
+    }
+  }
+
+  def _event(body):
+    return {
+      'httpMethod': 'POST',
+      'body': body,
+      'isBase64Encoded': False,
+      'queryStringParameters': {'user': 'xyz@example.com'}
+    }
+
+  benchmarks = [
+    ('valid request', _event(json.dumps(req_body))),
+    ('missing OutputLocation', _event(json.dumps(dict(req_body, ResultConfiguration={})))),
+    ('unknown key', _event(json.dumps(dict(req_body, Foo='bar')))),
+    ('invalid json', _event('{"QueryString": ')),
+    ('missing user', dict(_event(json.dumps(req_body)), queryStringParameters=None)),
+    ('body too large', _event(' ' * (MAX_BODY_BYTES + 1))),
+    ('deep nesting', _event('[' * 200000))
+  ]
+
+  def _validate(event):
+    try:
+      validate_request(event)
+    except ValidationError:
+      pass
+
+  for name, event in benchmarks:
+    elapsed = timeit.timeit(lambda: _validate(event), number=options.number)
+    print('{:<24} {:>8.2f} us/request'.format(name, elapsed / options.number * 1e6))
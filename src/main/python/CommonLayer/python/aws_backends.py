@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+#vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import datetime
+import threading
+
+import boto3
+
+
+class Boto3Backend:
+  '''AWS backend backed by boto3.
+
+  The handlers get their Athena, DynamoDB, S3, SES and Firehose clients from
+  the active backend instead of calling boto3 directly, so the whole pipeline
+  can run against in-memory fakes. Every method returns an object with the
+  same methods and response shapes as the boto3 client (or DynamoDB `Table`
+  resource) of the service.
+
+  boto3 sessions and resources are not thread safe, so clients are cached per
+  thread. Only threads that outlive an invocation, i.e. the main thread and
+  long-lived worker pools, reuse their clients across Lambda invocations of a
+  warm container; a thread started per invocation creates new ones.
+
+  `utcnow` is the clock of the handlers, so a fake backend can run them on
+  virtual time.
+  '''
+
+  def __init__(self):
+    self._local = threading.local()
+
+  def _get_cache(self):
+    if not hasattr(self._local, 'cache'):
+      self._local.session = boto3.session.Session()
+      self._local.cache = {}
+    return self._local.cache
+
+  def _client(self, service_name, region_name, endpoint_url=None):
+    cache = self._get_cache()
+    key = ('client', service_name, region_name, endpoint_url)
+    if key not in cache:
+      cache[key] = self._local.session.client(service_name,
+        region_name=region_name, endpoint_url=endpoint_url)
+    return cache[key]
+
+  def utcnow(self):
+    return datetime.datetime.utcnow()
+
+  def athena(self, region_name):
+    return self._client('athena', region_name)
+
+  def dynamodb_table(self, table_name, region_name):
+    cache = self._get_cache()
+    key = ('dynamodb_table', table_name, region_name)
+    if key not in cache:
+      dynamodb = self._local.session.resource('dynamodb', region_name=region_name)
+      cache[key] = dynamodb.Table(table_name)
+    return cache[key]
+
+  def s3(self, region_name, endpoint_url=None):
+    return self._client('s3', region_name, endpoint_url=endpoint_url)
+
+  def ses(self, region_name):
+    return self._client('ses', region_name)
+
+  def firehose(self, region_name):
+    return self._client('firehose', region_name)
+
+
+_BACKEND = None
+
+
+def get_backend():
+  global _BACKEND
+  if _BACKEND is None:
+    _BACKEND = Boto3Backend()
+  return _BACKEND
+
+
+def set_backend(backend):
+  '''Replace the active backend, e.g. with in-memory fakes for tests.'''
+  global _BACKEND
+  _BACKEND = backend
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+#vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import sys
+import time
+import logging
+
+import boto3
+
+LOGGER = logging.getLogger()
+if len(LOGGER.handlers) > 0:
+  # The Lambda environment pre-configures a handler logging to stderr.
+  # If a handler is already configured, `.basicConfig` does not execute.
+  # Thus we set the level directly.
+  LOGGER.setLevel(logging.INFO)
+else:
+  logging.basicConfig(level=logging.INFO)
+
+
+#XXX: The history dataset is at-least-once, e.g. a retried event or the sweeper
+# can complete the same query twice, so every report reads the latest record per query.
+QUERY_HISTORY_CTE = '''WITH history AS (
+  SELECT *
+  FROM (
+    SELECT *,
+      row_number() OVER (PARTITION BY query_id ORDER BY completed_at DESC, dt DESC) AS rn
+    FROM {table}
+    WHERE dt >= '{start_dt}'
+  )
+  WHERE rn = 1
+)'''
+
+P95_QUEUE_WAIT_QUERY = QUERY_HISTORY_CTE + '''
+SELECT work_group,
+  count(*) AS queries,
+  approx_percentile(queue_time_ms, 0.5) AS p50_queue_wait_ms,
+  approx_percentile(queue_time_ms, 0.95) AS p95_queue_wait_ms,
+  max(queue_time_ms) AS max_queue_wait_ms
+FROM history
+GROUP BY work_group
+ORDER BY p95_queue_wait_ms DESC'''
+
+TOP_SCANNERS_QUERY = QUERY_HISTORY_CTE + '''
+SELECT user_id,
+  count(*) AS queries,
+  sum(data_scanned_bytes) AS data_scanned_bytes,
+  round(sum(data_scanned_bytes) / pow(1024, 4), 4) AS data_scanned_tb
+FROM history
+GROUP BY user_id
+ORDER BY data_scanned_bytes DESC
+LIMIT {top}'''
+
+#XXX: Peak concurrency is computed with a sweep line over submission(+1) and completion(-1) events.
+HOURLY_CONCURRENCY_QUERY = QUERY_HISTORY_CTE + ''',
+events AS (
+  SELECT submitted_at AS ts, 1 AS delta
+  FROM history
+  WHERE submitted_at IS NOT NULL AND completed_at IS NOT NULL
+  UNION ALL
+  SELECT completed_at AS ts, -1 AS delta
+  FROM history
+  WHERE submitted_at IS NOT NULL AND completed_at IS NOT NULL
+), running AS (
+  SELECT ts, delta,
+    sum(delta) OVER (ORDER BY ts, delta ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW) AS concurrency
+  FROM events
+)
+SELECT date_trunc('hour', from_unixtime(ts / 1000e0)) AS hour,
+  max(concurrency) AS peak_concurrency,
+  count_if(delta = 1) AS submitted_queries
+FROM running
+GROUP BY 1
+ORDER BY 1'''
+
+REPORTS = [
+  ('p95 queue wait', P95_QUEUE_WAIT_QUERY),
+  ('top scanners', TOP_SCANNERS_QUERY),
+  ('hourly concurrency', HOURLY_CONCURRENCY_QUERY)
+]
+
+
+def run_athena_query(athena_client, query_string, database, work_group, output_location,
+  poll_interval=1.0):
+  query_kwargs = {
+    'QueryString': query_string,
+    'QueryExecutionContext': {'Database': database},
+    'WorkGroup': work_group
+  }
+  if output_location:
+    query_kwargs['ResultConfiguration'] = {'OutputLocation': output_location}
+
+  response = athena_client.start_query_execution(**query_kwargs)
+  query_execution_id = response['QueryExecutionId']
+  LOGGER.debug('QueryExecutionId: %s' % query_execution_id)
+
+  while True:
+    response = athena_client.get_query_execution(QueryExecutionId=query_execution_id)
+    status = response['QueryExecution']['Status']
+    if status['State'] in ('SUCCEEDED', 'FAILED', 'CANCELLED'):
+      break
+    time.sleep(poll_interval)
+
+  if status['State'] != 'SUCCEEDED':
+    raise RuntimeError('Athena Query is {}: {}'.format(status['State'],
+      status.get('StateChangeReason', '')))
+
+  rows = []
+  paginator = athena_client.get_paginator('get_query_results')
+  for page in paginator.paginate(QueryExecutionId=query_execution_id):
+    for row in page['ResultSet']['Rows']:
+      rows.append([col.get('VarCharValue', '') for col in row['Data']])
+  return rows
+
+
+def print_table(title, rows, out=sys.stdout):
+  print('## {}'.format(title), file=out)
+  if not rows:
+    print('(no data)', file=out)
+    return
+  widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+  for n, row in enumerate(rows):
+    print('  '.join(col.ljust(width) for col, width in zip(row, widths)), file=out)
+    if n == 0:
+      print('  '.join('-' * width for width in widths), file=out)
+  print(file=out)
+
+
+if __name__ == '__main__':
+  import argparse
+  import datetime
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--region-name', default='us-east-1',
+    help='aws region name: default=us-east-1')
+  parser.add_argument('--database', default='athena_cqrs_history',
+    help='query history database: default=athena_cqrs_history')
+  parser.add_argument('--table', default='query_history',
+    help='query history table: default=query_history')
+  parser.add_argument('--work-group-name', default='primary',
+    help='aws athena work group name: default=primary')
+  parser.add_argument('--output-location', default=None,
+    help='aws athena query output location. ex) s3://bucket-name/path/to/object')
+  parser.add_argument('--days', type=int, default=7,
+    help='number of days to report on: default=7')
+  parser.add_argument('--top', type=int, default=10,
+    help='number of top scanners: default=10')
+
+  options = parser.parse_args()
+
+  start_date = datetime.datetime.utcnow() - datetime.timedelta(days=options.days)
+  query_params = {
+    'table': options.table,
+    'start_dt': start_date.strftime('%Y-%m-%d'),
+    'top': options.top
+  }
+
+  athena_client = boto3.client('athena', region_name=options.region_name)
+  for title, query_format in REPORTS:
+    rows = run_athena_query(athena_client, query_format.format(**query_params),
+      options.database, options.work_group_name, options.output_location)
+    print_table(title, rows)
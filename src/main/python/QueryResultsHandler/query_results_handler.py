@@ -3,16 +3,24 @@
 #vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
 
 import os
+import json
+import math
+import time
+import uuid
 import logging
 from urllib.parse import urlparse
 
-import boto3
+import datetime
+
 import botocore
 from boto3.dynamodb.conditions import (
   Key,
   Attr
 )
 
+import aws_backends
+import results_delivery
+
 LOGGER = logging.getLogger()
 if len(LOGGER.handlers) > 0:
   # The Lambda environment pre-configures a handler logging to stderr.
@@ -26,6 +34,22 @@ AWS_REGION_NAME = os.getenv('AWS_REGION_NAME', 'us-east-1')
 DOWNLOAD_URL_TTL = int(os.getenv('DOWNLOAD_URL_TTL', '3600'))
 DDB_TABLE_NAME = os.getenv('DDB_TABLE_NAME')
 EMAIL_FROM_ADDRESS = os.getenv('EMAIL_FROM_ADDRESS')
+QUERY_HISTORY_DELIVERY_STREAM_NAME = os.getenv('QUERY_HISTORY_DELIVERY_STREAM_NAME')
+
+TERMINAL_QUERY_STATES = ('SUCCEEDED', 'FAILED', 'CANCELLED')
+NON_TERMINAL_QUERY_STATES = ('QUEUED', 'RUNNING')
+
+#XXX: A tracking row is COMPLETING while its owner delivers the results and sends
+# the email. A claim older than CLAIM_TIMEOUT_MINUTES can be taken over, so it
+# must outlive a Lambda timeout plus the retries of an asynchronous invocation.
+CLAIMED_QUERY_STATE = 'COMPLETING'
+CLAIM_TIMEOUT_MINUTES = int(os.getenv('CLAIM_TIMEOUT_MINUTES', '30'))
+
+#XXX: Seconds kept in reserve to checkpoint the results delivery before the Lambda times out.
+DELIVERY_DEADLINE_MARGIN = 30
+
+#XXX: PutRecordBatch accepts up to 500 records per call.
+FIREHOSE_BATCH_MAX_RECORDS = 500
 
 
 def gen_html(elem):
@@ -73,7 +97,7 @@ tr:nth-child(even) {{
 
 
 def send_email(from_addr, to_addrs, subject, html_body):
-  ses_client = boto3.client('ses', region_name=AWS_REGION_NAME)
+  ses_client = aws_backends.get_backend().ses(AWS_REGION_NAME)
   ret = ses_client.send_email(Destination={'ToAddresses': to_addrs},
     Message={'Body': {
         'Html': {
@@ -92,8 +116,7 @@ def send_email(from_addr, to_addrs, subject, html_body):
 
 
 def get_user_id_by_query_id(table, query_execution_id):
-  dynamodb = boto3.resource('dynamodb', region_name=AWS_REGION_NAME)
-  ddb_table = dynamodb.Table(table)
+  ddb_table = aws_backends.get_backend().dynamodb_table(table, AWS_REGION_NAME)
   try:
     #TODO: should handle ProvisionedThroughputExceededException
     ddb_attributes = ddb_table.query(
@@ -111,14 +134,18 @@ def get_user_id_by_query_id(table, query_execution_id):
   return record
 
 
-def update_query_status(table, user_id, query_execution_id, query_state):
-  dynamodb = boto3.resource('dynamodb', region_name=AWS_REGION_NAME)
-  ddb_table = dynamodb.Table(table)
+def update_query_status(table, user_id, query_execution_id, query_state, expected_states=None):
+  ddb_table = aws_backends.get_backend().dynamodb_table(table, AWS_REGION_NAME)
+  condition_expression = Attr('query_id').eq(query_execution_id)
+  if expected_states:
+    condition_expression = condition_expression & Attr('query_status').is_in(list(expected_states))
+
+  response = None
   try:
     response = ddb_table.update_item(
       Key={'user_id': user_id},
       UpdateExpression='SET query_status = :query_status',
-      ConditionExpression=Attr('query_id').eq(query_execution_id),
+      ConditionExpression=condition_expression,
       ExpressionAttributeValues={':query_status': query_state},
       ReturnValues='UPDATED_NEW')
   except botocore.exceptions.ClientError as ex:
@@ -129,17 +156,50 @@ def update_query_status(table, user_id, query_execution_id, query_state):
   return response
 
 
-def get_athena_query_result_location(query_execution_id):
-  athena_client = boto3.client('athena', region_name=AWS_REGION_NAME)
+def get_claim_expired_before():
+  claim_expired_date = aws_backends.get_backend().utcnow() - datetime.timedelta(minutes=CLAIM_TIMEOUT_MINUTES)
+  return math.ceil(claim_expired_date.timestamp())
+
+
+def claim_query(table, user_id, query_execution_id, claimed_by):
+  '''Move a tracking row to COMPLETING, so only one caller completes the query.
+
+  The claim succeeds for a non-terminal row, for a row already claimed by
+  `claimed_by` (a retry of the same invocation), or for a claim that timed out.
+  Returns True if the caller owns the row.
+  '''
+  ddb_table = aws_backends.get_backend().dynamodb_table(table, AWS_REGION_NAME)
+  claimable = Attr('query_status').is_in(list(NON_TERMINAL_QUERY_STATES)) \
+    | (Attr('query_status').eq(CLAIMED_QUERY_STATE)
+      & (Attr('claimed_by').eq(claimed_by) | Attr('claimed_at').lt(get_claim_expired_before())))
+  try:
+    ddb_table.update_item(
+      Key={'user_id': user_id},
+      UpdateExpression='SET query_status = :query_status, claimed_by = :claimed_by, claimed_at = :claimed_at',
+      ConditionExpression=Attr('query_id').eq(query_execution_id) & claimable,
+      ExpressionAttributeValues={
+        ':query_status': CLAIMED_QUERY_STATE,
+        ':claimed_by': claimed_by,
+        ':claimed_at': math.ceil(aws_backends.get_backend().utcnow().timestamp())
+      })
+  except botocore.exceptions.ClientError as ex:
+    if ex.response['Error']['Code'] == 'ConditionalCheckFailedException':
+      LOGGER.info('query %s is completed or claimed by another caller' % query_execution_id)
+      return False
+    raise ex
+  return True
+
+
+def get_athena_query_execution(query_execution_id):
+  athena_client = aws_backends.get_backend().athena(AWS_REGION_NAME)
   response = athena_client.get_query_execution(
     QueryExecutionId=query_execution_id
   )
-  output_location = response['QueryExecution']['ResultConfiguration']['OutputLocation']
-  return output_location
+  return response['QueryExecution']
 
 
 def create_presigned_url(bucket_name, object_name, expiration=3600):
-  s3_client = boto3.client('s3', region_name=AWS_REGION_NAME)
+  s3_client = aws_backends.get_backend().s3(AWS_REGION_NAME)
   try:
     presigned_url = s3_client.generate_presigned_url('get_object',
                                                  Params={'Bucket': bucket_name,
@@ -152,41 +212,160 @@ def create_presigned_url(bucket_name, object_name, expiration=3600):
   return presigned_url
 
 
-def lambda_handler(event, context):
-  LOGGER.debug(event)
+def to_epoch_millis(dt):
+  return int(dt.timestamp() * 1000) if dt else None
 
-  current_query_state = event['detail']['currentState']
-  if current_query_state == 'FAILED':
-    raise RuntimeError('Athena Query is {}'.format(current_query_state))
-  if current_query_state != 'SUCCEEDED':
-    #TODO: send alert by sns
-    LOGGER.info('athena query state: %s' % current_query_state)
+
+def build_query_history_record(query_execution, user_id):
+  status = query_execution.get('Status', {})
+  statistics = query_execution.get('Statistics', {})
+  record = {
+    'query_id': query_execution['QueryExecutionId'],
+    'user_id': user_id,
+    'work_group': query_execution.get('WorkGroup'),
+    'database': query_execution.get('QueryExecutionContext', {}).get('Database'),
+    'statement_type': query_execution.get('StatementType'),
+    'query_state': status.get('State'),
+    'state_change_reason': status.get('StateChangeReason'),
+    'submitted_at': to_epoch_millis(status.get('SubmissionDateTime')),
+    'completed_at': to_epoch_millis(status.get('CompletionDateTime')),
+    'queue_time_ms': statistics.get('QueryQueueTimeInMillis'),
+    'planning_time_ms': statistics.get('QueryPlanningTimeInMillis'),
+    'engine_execution_time_ms': statistics.get('EngineExecutionTimeInMillis'),
+    'service_processing_time_ms': statistics.get('ServiceProcessingTimeInMillis'),
+    'total_execution_time_ms': statistics.get('TotalExecutionTimeInMillis'),
+    'data_scanned_bytes': statistics.get('DataScannedInBytes'),
+    'output_location': query_execution.get('ResultConfiguration', {}).get('OutputLocation')
+  }
+  return record
+
+
+def put_query_history_records(records):
+  '''Append completion records to the query history dataset.
+
+  Records go to a Kinesis Data Firehose delivery stream that buffers them and
+  writes micro-batches of gzip compressed JSON lines to S3.
+  '''
+  if not QUERY_HISTORY_DELIVERY_STREAM_NAME or not records:
     return
 
-  query_execution_id = event['detail']['queryExecutionId']
-  output_location = get_athena_query_result_location(query_execution_id)
-  LOGGER.info(output_location)
+  firehose_client = aws_backends.get_backend().firehose(AWS_REGION_NAME)
+  for i in range(0, len(records), FIREHOSE_BATCH_MAX_RECORDS):
+    batch = [{'Data': '{}\n'.format(json.dumps(record))}
+      for record in records[i:i + FIREHOSE_BATCH_MAX_RECORDS]]
+    try:
+      response = firehose_client.put_record_batch(
+        DeliveryStreamName=QUERY_HISTORY_DELIVERY_STREAM_NAME,
+        Records=batch
+      )
+    except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as ex:
+      #XXX: The email is already sent, so a failure here must not fail the invocation.
+      LOGGER.error(ex)
+      continue
+    if response.get('FailedPutCount', 0) > 0:
+      #XXX: query history is best-effort, so failed records are only logged.
+      LOGGER.error('failed to put %d query history records' % response['FailedPutCount'])
 
-  url_parse_result = urlparse(output_location, scheme='s3')
-  bucket_name, object_name = url_parse_result.netloc, url_parse_result.path.lstrip('/')
-  presigned_url = create_presigned_url(bucket_name, object_name, expiration=DOWNLOAD_URL_TTL)
-  LOGGER.info('presigned_url: %s' % presigned_url)
+
+def deliver_query_results(user_id, bucket_name, object_name, deadline=None):
+  delivery_location = results_delivery.get_results_delivery_location(user_id)
+  if not delivery_location:
+    return bucket_name, object_name
+
+  dst_bucket, dst_key = results_delivery.get_delivery_destination(delivery_location, object_name)
+  s3_client = results_delivery.create_s3_client()
+  return results_delivery.deliver_object(s3_client, bucket_name, object_name, dst_bucket, dst_key,
+    move=(results_delivery.RESULTS_DELIVERY_MODE == 'move'), deadline=deadline)
+
+
+def get_deadline(context):
+  if not hasattr(context, 'get_remaining_time_in_millis'):
+    return None
+  return time.time() + context.get_remaining_time_in_millis() / 1000.0 - DELIVERY_DEADLINE_MARGIN
+
+
+def complete_query(query_execution, claimed_by, deadline=None):
+  '''Finish a query that reached a terminal state.
+
+  The tracking row is claimed by `claimed_by` first, so the event path and the
+  QueryStatusSweeper never both complete the same query.
+  Successful queries get a download link mailed to the requester, after the
+  results are delivered to the requester's own location if one is configured;
+  in every case the tracking row in DynamoDB is moved to the final query state.
+  A delivery that does not finish by `deadline` raises `DeliveryIncompleteError`
+  and keeps the claim, so it is resumed by a retry with the same `claimed_by`.
+  `query_execution` is the `QueryExecution` structure returned by
+  `GetQueryExecution` or `BatchGetQueryExecution`.
+
+  Returns the query history record of the query, or None if another caller
+  owns the query.
+  '''
+  query_execution_id = query_execution['QueryExecutionId']
+  query_state = query_execution['Status']['State']
 
   try:
     record = get_user_id_by_query_id(DDB_TABLE_NAME, query_execution_id)
   except Exception as ex:
     raise ex
-  else:
+
+  #XXX: A row replaced by a newer query of the same user cannot be claimed,
+  # but only the event path can find such a query.
+  if 'user_id' in record and not claim_query(DDB_TABLE_NAME, record['user_id'],
+      query_execution_id, claimed_by):
+    return None
+
+  if query_state == 'SUCCEEDED':
+    output_location = query_execution['ResultConfiguration']['OutputLocation']
+    LOGGER.info(output_location)
+
+    url_parse_result = urlparse(output_location, scheme='s3')
+    bucket_name, object_name = url_parse_result.netloc, url_parse_result.path.lstrip('/')
+    user_id = record.get('user_id', EMAIL_FROM_ADDRESS)
+    #XXX: Without a tracking row the requester is unknown, so the results stay where Athena wrote them.
+    if 'user_id' in record:
+      bucket_name, object_name = deliver_query_results(user_id, bucket_name, object_name,
+        deadline=deadline)
+    presigned_url = create_presigned_url(bucket_name, object_name, expiration=DOWNLOAD_URL_TTL)
+    LOGGER.info('presigned_url: %s' % presigned_url)
+
     # send email to requester
     record['link'] = presigned_url
-    user_id = record.get('user_id', EMAIL_FROM_ADDRESS)
     html = gen_html(record)
     subject = '''Athena Query Results is ready'''
     send_email(EMAIL_FROM_ADDRESS, [user_id], subject, html)
-    try:
-      update_query_status(DDB_TABLE_NAME, user_id, query_execution_id, current_query_state)
-    except Exception as ex:
-      LOGGER.error(ex)
+  else:
+    user_id = record.get('user_id', EMAIL_FROM_ADDRESS)
+
+  try:
+    update_query_status(DDB_TABLE_NAME, user_id, query_execution_id, query_state)
+  except Exception as ex:
+    LOGGER.error(ex)
+  return build_query_history_record(query_execution, record.get('user_id'))
+
+
+def lambda_handler(event, context):
+  LOGGER.debug(event)
+
+  current_query_state = event['detail']['currentState']
+  if current_query_state not in TERMINAL_QUERY_STATES:
+    #TODO: send alert by sns
+    LOGGER.info('athena query state: %s' % current_query_state)
+    return
+
+  query_execution_id = event['detail']['queryExecutionId']
+  query_execution = get_athena_query_execution(query_execution_id)
+  #XXX: Retries of an event keep its id, so a retry takes over its own claim.
+  claimed_by = event.get('id') or getattr(context, 'aws_request_id', None) or str(uuid.uuid4())
+  history_record = complete_query(query_execution, claimed_by, deadline=get_deadline(context))
+  if history_record is None:
+    return
+  put_query_history_records([history_record])
+
+  #XXX: Do not raise for a FAILED query after the work is done; EventBridge invokes
+  # this function asynchronously, so the retries would repeat every side effect.
+  if current_query_state == 'FAILED':
+    LOGGER.error('Athena Query is %s: %s' % (current_query_state,
+      query_execution['Status'].get('StateChangeReason', '')))
   LOGGER.info("end")
 
 
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+#vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import os
+import logging
+import math
+import datetime
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import aws_backends
+from boto3.dynamodb.conditions import Attr
+
+import query_results_handler
+from query_results_handler import (
+  CLAIMED_QUERY_STATE,
+  NON_TERMINAL_QUERY_STATES,
+  TERMINAL_QUERY_STATES,
+  complete_query,
+  get_claim_expired_before,
+  get_deadline,
+  put_query_history_records,
+  update_query_status
+)
+
+LOGGER = logging.getLogger()
+if len(LOGGER.handlers) > 0:
+  # The Lambda environment pre-configures a handler logging to stderr.
+  # If a handler is already configured, `.basicConfig` does not execute.
+  # Thus we set the level directly.
+  LOGGER.setLevel(logging.INFO)
+else:
+  logging.basicConfig(level=logging.INFO)
+
+AWS_REGION_NAME = os.getenv('AWS_REGION_NAME', 'us-east-1')
+DDB_TABLE_NAME = os.getenv('DDB_TABLE_NAME')
+STALE_QUERY_MINUTES = int(os.getenv('STALE_QUERY_MINUTES', '30'))
+SCAN_TOTAL_SEGMENTS = int(os.getenv('SCAN_TOTAL_SEGMENTS', '4'))
+
+#XXX: CommandHandler sets `expired_at` to the submission time plus 7 days,
+# so the submission time of a tracking row is `expired_at - 7 days`.
+QUERY_TRACKING_TTL_DAYS = 7
+
+#XXX: BatchGetQueryExecution accepts up to 50 query execution ids per call.
+ATHENA_BATCH_GET_MAX_IDS = 50
+
+EXPIRED_QUERY_STATE = 'EXPIRED'
+
+#XXX: ErrorCode of BatchGetQueryExecution for an unknown query execution id
+NOT_FOUND_ERROR_CODE = 'INVALID_INPUT'
+
+
+#XXX: The scan threads outlive the invocation, so each of them reuses the
+# DynamoDB resource the backend caches per thread in a warm container.
+_SCAN_EXECUTORS = {}
+
+
+def get_scan_executor(max_workers):
+  if max_workers not in _SCAN_EXECUTORS:
+    _SCAN_EXECUTORS[max_workers] = ThreadPoolExecutor(max_workers=max_workers,
+      thread_name_prefix='scan')
+  return _SCAN_EXECUTORS[max_workers]
+
+
+def scan_stale_query_segment(table, segment, total_segments, submitted_before, claim_expired_before, now):
+  ddb_table = aws_backends.get_backend().dynamodb_table(table, AWS_REGION_NAME)
+
+  #XXX: A COMPLETING row is picked up only after its claim timed out, e.g. its owner
+  # exhausted the retries. Rows whose `expired_at` has already passed are waiting for
+  # the TTL deletion.
+  filter_expression = ((Attr('query_status').is_in(list(NON_TERMINAL_QUERY_STATES))
+      & Attr('expired_at').lt(submitted_before))
+    | (Attr('query_status').eq(CLAIMED_QUERY_STATE)
+      & Attr('claimed_at').lt(claim_expired_before))) \
+    & Attr('expired_at').gt(now)
+
+  scan_kwargs = {
+    'FilterExpression': filter_expression,
+    'ProjectionExpression': 'user_id, query_id, query_status',
+    'Segment': segment,
+    'TotalSegments': total_segments
+  }
+
+  items = []
+  while True:
+    #TODO: should handle ProvisionedThroughputExceededException
+    response = ddb_table.scan(**scan_kwargs)
+    items.extend(response.get('Items', []))
+    last_evaluated_key = response.get('LastEvaluatedKey')
+    if not last_evaluated_key:
+      break
+    scan_kwargs['ExclusiveStartKey'] = last_evaluated_key
+  return items
+
+
+def scan_stale_queries(table, stale_minutes, total_segments):
+  utc_now = aws_backends.get_backend().utcnow()
+  stale_date = utc_now + datetime.timedelta(days=QUERY_TRACKING_TTL_DAYS) \
+    - datetime.timedelta(minutes=stale_minutes)
+  submitted_before = math.ceil(stale_date.timestamp())
+  now = math.ceil(utc_now.timestamp())
+  claim_expired_before = get_claim_expired_before()
+
+  executor = get_scan_executor(total_segments)
+  futures = [executor.submit(scan_stale_query_segment, table, segment,
+    total_segments, submitted_before, claim_expired_before, now) for segment in range(total_segments)]
+  return [item for future in futures for item in future.result()]
+
+
+def batch_get_query_executions(query_execution_ids):
+  athena_client = aws_backends.get_backend().athena(AWS_REGION_NAME)
+
+  query_executions, unprocessed_query_ids = [], []
+  for i in range(0, len(query_execution_ids), ATHENA_BATCH_GET_MAX_IDS):
+    response = athena_client.batch_get_query_execution(
+      QueryExecutionIds=query_execution_ids[i:i + ATHENA_BATCH_GET_MAX_IDS]
+    )
+    query_executions.extend(response.get('QueryExecutions', []))
+    unprocessed_query_ids.extend(response.get('UnprocessedQueryExecutionIds', []))
+  return query_executions, unprocessed_query_ids
+
+
+def is_query_not_found(unprocessed_query_id):
+  error_code = unprocessed_query_id.get('ErrorCode') or ''
+  error_message = unprocessed_query_id.get('ErrorMessage') or ''
+  return error_code == NOT_FOUND_ERROR_CODE or 'not found' in error_message.lower()
+
+
+def lambda_handler(event, context):
+  LOGGER.debug(event)
+
+  stale_queries = scan_stale_queries(DDB_TABLE_NAME, STALE_QUERY_MINUTES, SCAN_TOTAL_SEGMENTS)
+  LOGGER.info('stale queries: %d' % len(stale_queries))
+
+  stale_queries_by_id = {item['query_id']: item for item in stale_queries}
+  query_executions, unprocessed_query_ids = batch_get_query_executions(list(stale_queries_by_id))
+
+  deadline = get_deadline(context)
+  claimed_by = getattr(context, 'aws_request_id', None) or str(uuid.uuid4())
+  summary = {'scanned': len(stale_queries), 'completed': 0, 'updated': 0, 'expired': 0,
+    'skipped': 0, 'errors': 0}
+  history_records = []
+  for query_execution in query_executions:
+    query_execution_id = query_execution['QueryExecutionId']
+    query_state = query_execution['Status']['State']
+    stale_query = stale_queries_by_id[query_execution_id]
+    try:
+      if query_state in TERMINAL_QUERY_STATES:
+        history_record = complete_query(query_execution, claimed_by, deadline=deadline)
+        if history_record is None:
+          summary['skipped'] += 1
+          continue
+        history_records.append(history_record)
+        summary['completed'] += 1
+      elif query_state != stale_query['query_status']:
+        #XXX: The event path may have claimed the row since the scan.
+        if update_query_status(DDB_TABLE_NAME, stale_query['user_id'], query_execution_id, query_state,
+            expected_states=[stale_query['query_status']]):
+          summary['updated'] += 1
+    except Exception as ex:
+      LOGGER.error('failed to reconcile query %s: %s' % (query_execution_id, repr(ex)))
+      summary['errors'] += 1
+
+  for unprocessed_query_id in unprocessed_query_ids:
+    query_execution_id = unprocessed_query_id['QueryExecutionId']
+    LOGGER.info('unprocessed query %s: %s' % (query_execution_id,
+      unprocessed_query_id.get('ErrorMessage', unprocessed_query_id.get('ErrorCode'))))
+    #XXX: Throttling and internal errors are also reported as unprocessed,
+    # so only the query ids Athena does not know any more are expired.
+    if not is_query_not_found(unprocessed_query_id):
+      summary['errors'] += 1
+      continue
+    stale_query = stale_queries_by_id[query_execution_id]
+    try:
+      if update_query_status(DDB_TABLE_NAME, stale_query['user_id'], query_execution_id,
+          EXPIRED_QUERY_STATE, expected_states=[stale_query['query_status']]):
+        summary['expired'] += 1
+    except Exception as ex:
+      LOGGER.error('failed to expire query %s: %s' % (query_execution_id, repr(ex)))
+      summary['errors'] += 1
+
+  put_query_history_records(history_records)
+
+  LOGGER.info(summary)
+  return summary
+
+
+if __name__ == '__main__':
+  import argparse
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--region-name', default='us-east-1',
+    help='aws region name: default=us-east-1')
+  parser.add_argument('--dynamodb-table', required=True,
+    help='aws dynamodb table')
+  parser.add_argument('--sender-email', required=True,
+    help='sender email address')
+  parser.add_argument('--stale-minutes', type=int, default=30,
+    help='minimum age in minutes of a non-terminal query to reconcile: default=30')
+  parser.add_argument('--total-segments', type=int, default=4,
+    help='number of parallel dynamodb scan segments: default=4')
+
+  options = parser.parse_args()
+  AWS_REGION_NAME = options.region_name
+  DDB_TABLE_NAME = options.dynamodb_table
+  STALE_QUERY_MINUTES = options.stale_minutes
+  SCAN_TOTAL_SEGMENTS = options.total_segments
+
+  query_results_handler.AWS_REGION_NAME = options.region_name
+  query_results_handler.DDB_TABLE_NAME = options.dynamodb_table
+  query_results_handler.EMAIL_FROM_ADDRESS = options.sender_email
+
+  lambda_handler({}, {})
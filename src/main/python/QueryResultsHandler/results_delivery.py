@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+#vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import os
+import json
+import math
+import time
+import logging
+import posixpath
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+
+import botocore
+
+import aws_backends
+
+LOGGER = logging.getLogger()
+if len(LOGGER.handlers) > 0:
+  # The Lambda environment pre-configures a handler logging to stderr.
+  # If a handler is already configured, `.basicConfig` does not execute.
+  # Thus we set the level directly.
+  LOGGER.setLevel(logging.INFO)
+else:
+  logging.basicConfig(level=logging.INFO)
+
+AWS_REGION_NAME = os.getenv('AWS_REGION_NAME', 'us-east-1')
+#XXX: Set S3_ENDPOINT_URL to run the delivery against a local S3 stand-in such as MinIO.
+S3_ENDPOINT_URL = os.getenv('S3_ENDPOINT_URL')
+RESULTS_DELIVERY_TARGETS = json.loads(os.getenv('RESULTS_DELIVERY_TARGETS', '{}'))
+RESULTS_DELIVERY_MODE = os.getenv('RESULTS_DELIVERY_MODE', 'copy')
+RESULTS_DELIVERY_PART_SIZE = int(os.getenv('RESULTS_DELIVERY_PART_SIZE_MB', '128')) * 1024 * 1024
+RESULTS_DELIVERY_MAX_WORKERS = int(os.getenv('RESULTS_DELIVERY_MAX_WORKERS', '8'))
+
+#XXX: S3 multipart upload limits
+# https://docs.aws.amazon.com/AmazonS3/latest/userguide/qfacts.html
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PART_COUNT = 10000
+MAX_COPY_OBJECT_SIZE = 5 * 1024 * 1024 * 1024
+
+CHECKPOINT_SUFFIX = '.delivery.json'
+CHECKPOINT_EVERY_PARTS = 16
+
+#XXX: The upload or its source is gone, so resuming the checkpoint can never succeed.
+# NoSuchKey is raised when a concurrent move already deleted the source object.
+UNRECOVERABLE_ERROR_CODES = ('NoSuchUpload', 'NoSuchKey', 'PreconditionFailed')
+
+
+class DeliveryIncompleteError(RuntimeError):
+  '''Raised when the deadline is reached before every part is copied.
+
+  The progress is saved in the checkpoint object, so calling
+  `deliver_object` again resumes the copy.
+  '''
+  pass
+
+
+def create_s3_client():
+  return aws_backends.get_backend().s3(AWS_REGION_NAME, endpoint_url=S3_ENDPOINT_URL)
+
+
+def get_results_delivery_location(user_id, targets=None):
+  '''Find the delivery location of a user.
+
+  `targets` maps a user id (email address) or an email domain starting with
+  `@` to an S3 location, e.g. {"xyz@example.com": "s3://bucket/prefix/"}.
+  An exact user id takes precedence over its domain.
+  '''
+  targets = RESULTS_DELIVERY_TARGETS if targets is None else targets
+  if not user_id:
+    return None
+  if user_id in targets:
+    return targets[user_id]
+  _, _, domain = user_id.rpartition('@')
+  return targets.get('@{}'.format(domain)) if domain else None
+
+
+def get_delivery_destination(delivery_location, src_key):
+  url_parse_result = urlparse(delivery_location, scheme='s3')
+  dst_bucket = url_parse_result.netloc
+  dst_key = posixpath.join(url_parse_result.path.lstrip('/'), posixpath.basename(src_key))
+  return dst_bucket, dst_key
+
+
+def load_checkpoint(s3_client, bucket, key):
+  try:
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+  except botocore.exceptions.ClientError as ex:
+    if ex.response['Error']['Code'] in ('NoSuchKey', '404'):
+      return None
+    raise ex
+  return json.loads(response['Body'].read())
+
+
+def save_checkpoint(s3_client, bucket, key, checkpoint):
+  s3_client.put_object(Bucket=bucket, Key=key,
+    Body=json.dumps(checkpoint).encode('utf-8'),
+    ContentType='application/json')
+
+
+def delete_checkpoint(s3_client, bucket, key):
+  s3_client.delete_object(Bucket=bucket, Key=key)
+
+
+def get_part_size(object_size, part_size):
+  part_size = max(part_size, MIN_PART_SIZE, int(math.ceil(object_size / float(MAX_PART_COUNT))))
+  #XXX: A part of UploadPartCopy is at most 5 GiB, same as CopyObject.
+  return min(part_size, MAX_COPY_OBJECT_SIZE)
+
+
+def abort_multipart_upload(s3_client, bucket, key, upload_id):
+  try:
+    s3_client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+  except botocore.exceptions.ClientError as ex:
+    if ex.response['Error']['Code'] != 'NoSuchUpload':
+      raise ex
+
+
+def upload_part_copy(s3_client, src_bucket, src_key, src_etag, dst_bucket, dst_key,
+  upload_id, part_number, byte_range):
+  response = s3_client.upload_part_copy(
+    Bucket=dst_bucket,
+    Key=dst_key,
+    UploadId=upload_id,
+    PartNumber=part_number,
+    CopySource={'Bucket': src_bucket, 'Key': src_key},
+    CopySourceIfMatch=src_etag,
+    CopySourceRange='bytes={}-{}'.format(*byte_range)
+  )
+  return part_number, response['CopyPartResult']['ETag']
+
+
+def multipart_copy(s3_client, src_bucket, src_key, src_etag, object_size, dst_bucket, dst_key,
+  checkpoint_key, part_size, max_workers, deadline=None):
+  checkpoint = load_checkpoint(s3_client, src_bucket, checkpoint_key)
+  if checkpoint and (checkpoint['src_etag'], checkpoint['dst_bucket'], checkpoint['dst_key']) \
+      != (src_etag, dst_bucket, dst_key):
+    LOGGER.info('discard stale checkpoint: s3://%s/%s' % (src_bucket, checkpoint_key))
+    #XXX: Parts of an abandoned multipart upload are billed until it is aborted.
+    abort_multipart_upload(s3_client, checkpoint['dst_bucket'], checkpoint['dst_key'],
+      checkpoint['upload_id'])
+    checkpoint = None
+
+  if checkpoint is None:
+    response = s3_client.create_multipart_upload(Bucket=dst_bucket, Key=dst_key)
+    checkpoint = {
+      'src_etag': src_etag,
+      'dst_bucket': dst_bucket,
+      'dst_key': dst_key,
+      'upload_id': response['UploadId'],
+      'part_size': get_part_size(object_size, part_size),
+      'parts': {}
+    }
+    save_checkpoint(s3_client, src_bucket, checkpoint_key, checkpoint)
+  else:
+    LOGGER.info('resume multipart copy: %d parts done' % len(checkpoint['parts']))
+
+  upload_id, part_size = checkpoint['upload_id'], checkpoint['part_size']
+  part_count = int(math.ceil(object_size / float(part_size)))
+  #XXX: JSON object keys are strings, so part numbers are kept as strings in the checkpoint.
+  pending_parts = [part_number for part_number in range(1, part_count + 1)
+    if str(part_number) not in checkpoint['parts']]
+
+  #XXX: Set by the first failed part, so the queued parts are skipped while
+  # the ETags of the parts already in flight are still recorded.
+  stopped = threading.Event()
+
+  def _copy_part(part_number):
+    if stopped.is_set() or (deadline and time.time() > deadline):
+      return part_number, None
+    start = (part_number - 1) * part_size
+    end = min(start + part_size, object_size) - 1
+    try:
+      return upload_part_copy(s3_client, src_bucket, src_key, src_etag, dst_bucket, dst_key,
+        upload_id, part_number, (start, end))
+    except Exception:
+      stopped.set()
+      raise
+
+  failure = None
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    futures = [executor.submit(_copy_part, part_number) for part_number in pending_parts]
+    for n, future in enumerate(as_completed(futures), 1):
+      try:
+        part_number, etag = future.result()
+      except Exception as ex:
+        failure = failure or ex
+        continue
+      if etag is not None:
+        checkpoint['parts'][str(part_number)] = etag
+      if failure is None and n % CHECKPOINT_EVERY_PARTS == 0:
+        save_checkpoint(s3_client, src_bucket, checkpoint_key, checkpoint)
+
+  if failure is not None:
+    if isinstance(failure, botocore.exceptions.ClientError) \
+        and failure.response['Error']['Code'] in UNRECOVERABLE_ERROR_CODES:
+      #XXX: Discard the checkpoint instead of saving a stale one, so the next attempt starts over.
+      abort_multipart_upload(s3_client, dst_bucket, dst_key, upload_id)
+      delete_checkpoint(s3_client, src_bucket, checkpoint_key)
+    else:
+      save_checkpoint(s3_client, src_bucket, checkpoint_key, checkpoint)
+    raise failure
+
+  if len(checkpoint['parts']) < part_count:
+    save_checkpoint(s3_client, src_bucket, checkpoint_key, checkpoint)
+    raise DeliveryIncompleteError('copied {} of {} parts of s3://{}/{}'.format(
+      len(checkpoint['parts']), part_count, src_bucket, src_key))
+
+  parts = [{'PartNumber': int(part_number), 'ETag': etag}
+    for part_number, etag in sorted(checkpoint['parts'].items(), key=lambda e: int(e[0]))]
+  s3_client.complete_multipart_upload(Bucket=dst_bucket, Key=dst_key,
+    UploadId=upload_id, MultipartUpload={'Parts': parts})
+  delete_checkpoint(s3_client, src_bucket, checkpoint_key)
+
+
+def deliver_object(s3_client, src_bucket, src_key, dst_bucket, dst_key, move=False,
+  part_size=None, max_workers=None, deadline=None):
+  '''Copy (or move) an object with server-side copies only.
+
+  Objects larger than `part_size` are copied by `UploadPartCopy` with
+  `max_workers` parallel part workers. The progress is checkpointed next to the
+  source object, so a copy interrupted by `deadline` (epoch seconds) or a
+  Lambda timeout resumes where it stopped.
+
+  The checkpoint has a single writer only if the caller owns the copy, e.g.
+  `complete_query` delivers only after it claimed the query tracking row.
+  '''
+  part_size = part_size or RESULTS_DELIVERY_PART_SIZE
+  max_workers = max_workers or RESULTS_DELIVERY_MAX_WORKERS
+
+  try:
+    response = s3_client.head_object(Bucket=src_bucket, Key=src_key)
+  except botocore.exceptions.ClientError as ex:
+    if move and ex.response['Error']['Code'] in ('NoSuchKey', '404'):
+      #XXX: The source of a finished move is already gone.
+      s3_client.head_object(Bucket=dst_bucket, Key=dst_key)
+      return dst_bucket, dst_key
+    raise ex
+  object_size, src_etag = response['ContentLength'], response['ETag']
+
+  if object_size <= min(part_size, MAX_COPY_OBJECT_SIZE):
+    s3_client.copy_object(Bucket=dst_bucket, Key=dst_key,
+      CopySource={'Bucket': src_bucket, 'Key': src_key},
+      CopySourceIfMatch=src_etag)
+  else:
+    checkpoint_key = '{}{}'.format(src_key, CHECKPOINT_SUFFIX)
+    multipart_copy(s3_client, src_bucket, src_key, src_etag, object_size, dst_bucket, dst_key,
+      checkpoint_key, part_size, max_workers, deadline=deadline)
+
+  if move:
+    s3_client.delete_object(Bucket=src_bucket, Key=src_key)
+  LOGGER.info('delivered s3://%s/%s to s3://%s/%s' % (src_bucket, src_key, dst_bucket, dst_key))
+  return dst_bucket, dst_key
+
+
+if __name__ == '__main__':
+  import argparse
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--region-name', default='us-east-1',
+    help='aws region name: default=us-east-1')
+  parser.add_argument('--endpoint-url', default=None,
+    help='s3 endpoint url of a local s3 stand-in. ex) http://localhost:9000')
+  parser.add_argument('--source', required=True,
+    help='source object. ex) s3://bucket-name/query-results/query-id.csv')
+  parser.add_argument('--destination', required=True,
+    help='destination location. ex) s3://bucket-name/path/to/')
+  parser.add_argument('--move', action='store_true',
+    help='delete the source object after the copy')
+  parser.add_argument('--part-size-mb', type=int, default=128,
+    help='multipart copy part size in MB: default=128')
+  parser.add_argument('--max-workers', type=int, default=8,
+    help='number of parallel part workers: default=8')
+
+  options = parser.parse_args()
+  AWS_REGION_NAME = options.region_name
+  S3_ENDPOINT_URL = options.endpoint_url
+
+  url_parse_result = urlparse(options.source, scheme='s3')
+  src_bucket, src_key = url_parse_result.netloc, url_parse_result.path.lstrip('/')
+  dst_bucket, dst_key = get_delivery_destination(options.destination, src_key)
+
+  deliver_object(create_s3_client(), src_bucket, src_key, dst_bucket, dst_key,
+    move=options.move, part_size=options.part_size_mb * 1024 * 1024,
+    max_workers=options.max_workers)
@@ -0,0 +1,651 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+#vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import re
+import copy
+import time
+import uuid
+import zlib
+import random
+import hashlib
+import datetime
+import threading
+
+import botocore.exceptions
+
+
+class FakeClock:
+  '''Virtual clock that drives the Athena query lifecycles.'''
+
+  EPOCH = datetime.datetime(2020, 11, 24, tzinfo=datetime.timezone.utc)
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._now = 0.0
+
+  def now(self):
+    with self._lock:
+      return self._now
+
+  def advance(self, seconds):
+    with self._lock:
+      self._now += seconds
+      return self._now
+
+  def to_datetime(self, seconds):
+    return self.EPOCH + datetime.timedelta(seconds=seconds)
+
+
+def client_error(code, message, operation_name):
+  return botocore.exceptions.ClientError(
+    {'Error': {'Code': code, 'Message': message}}, operation_name)
+
+
+class FakeService:
+  '''Base class of the fake services.
+
+  Every call sleeps for a random latency in `latency_ms` and is throttled with
+  probability `throttle_rate`. Throttled calls are retried with exponential
+  backoff like the botocore retry handler, and `ClientError` is raised once
+  `max_attempts` is exhausted.
+
+  The random draws of a call are seeded with the operation, the request key
+  (e.g. the item key or the object key) and how many times that request was
+  made, so a request gets the same latency and throttling however the
+  concurrent calls interleave.
+  '''
+
+  THROTTLING_ERROR_CODE = 'ThrottlingException'
+
+  def __init__(self, seed=0, latency_ms=(0, 0), throttle_rate=0.0, max_attempts=5,
+    backoff_ms=1.0):
+    self._lock = threading.RLock()
+    self._request_counts = {}
+    self.seed = seed
+    self.latency_ms = latency_ms
+    self.throttle_rate = throttle_rate
+    self.max_attempts = max_attempts
+    self.backoff_ms = backoff_ms
+    self.calls = {}
+    self.throttled = 0
+
+  def _call(self, operation_name, *request_key):
+    '''Play the latency and throttling of a call, and return its random generator.'''
+    request = '/'.join(str(e) for e in (operation_name,) + request_key)
+    with self._lock:
+      self.calls[operation_name] = self.calls.get(operation_name, 0) + 1
+      self._request_counts[request] = self._request_counts.get(request, 0) + 1
+      rng = random.Random('{}-{}-{}'.format(self.seed, request, self._request_counts[request]))
+
+    for attempt in range(1, self.max_attempts + 1):
+      low, high = self.latency_ms
+      if high > 0:
+        time.sleep((low + (high - low) * rng.random()) / 1000.0)
+      if rng.random() >= self.throttle_rate:
+        return rng
+      with self._lock:
+        self.throttled += 1
+      if attempt < self.max_attempts:
+        time.sleep(self.backoff_ms * (2 ** (attempt - 1)) * rng.random() / 1000.0)
+    raise client_error(self.THROTTLING_ERROR_CODE, 'Rate exceeded', operation_name)
+
+
+#XXX: boto3 condition objects are evaluated through `get_expression()`.
+_COMPARATORS = {
+  '=': lambda a, b: a == b,
+  '<>': lambda a, b: a != b,
+  '<': lambda a, b: a < b,
+  '<=': lambda a, b: a <= b,
+  '>': lambda a, b: a > b,
+  '>=': lambda a, b: a >= b,
+  'IN': lambda a, b: a in b
+}
+
+_MISSING = object()
+
+
+def evaluate_condition(condition, item):
+  expression = condition.get_expression()
+  operator, values = expression['operator'], expression['values']
+  if operator == 'AND':
+    return evaluate_condition(values[0], item) and evaluate_condition(values[1], item)
+  if operator == 'OR':
+    return evaluate_condition(values[0], item) or evaluate_condition(values[1], item)
+  if operator == 'NOT':
+    return not evaluate_condition(values[0], item)
+  if operator == 'BETWEEN':
+    value = item.get(values[0].name, _MISSING)
+    return value is not _MISSING and values[1] <= value <= values[2]
+  if operator == 'attribute_exists':
+    return values[0].name in item
+  if operator == 'attribute_not_exists':
+    return values[0].name not in item
+  if operator not in _COMPARATORS:
+    raise NotImplementedError('unsupported condition operator: {}'.format(operator))
+  value = item.get(values[0].name, _MISSING)
+  return value is not _MISSING and _COMPARATORS[operator](value, values[1])
+
+
+class FakeDynamoDBTable(FakeService):
+  '''In-memory DynamoDB `Table` with a hash key and KEYS_ONLY global secondary indexes.
+
+  Every index is named after its partition key, like the `query_id` index.
+  '''
+
+  THROTTLING_ERROR_CODE = 'ProvisionedThroughputExceededException'
+
+  def __init__(self, table_name, hash_key='user_id', index_keys=('query_id',),
+    scan_page_size=100, **kwargs):
+    super().__init__(**kwargs)
+    self.table_name = table_name
+    self.hash_key = hash_key
+    self.index_keys = index_keys
+    self.scan_page_size = scan_page_size
+    self.items = {}
+    self.indexes = {index_key: {} for index_key in index_keys}
+
+  def _store(self, key, item):
+    old_item = self.items.get(key, {})
+    for index_key, index in self.indexes.items():
+      if index_key in old_item:
+        index.get(old_item[index_key], set()).discard(key)
+      if item is not None and index_key in item:
+        index.setdefault(item[index_key], set()).add(key)
+    if item is None:
+      self.items.pop(key, None)
+    else:
+      self.items[key] = item
+
+  def put_item(self, Item, ConditionExpression=None, **kwargs):
+    self._call('PutItem', Item[self.hash_key])
+    with self._lock:
+      key = Item[self.hash_key]
+      if ConditionExpression is not None and \
+          not evaluate_condition(ConditionExpression, self.items.get(key, {})):
+        raise client_error('ConditionalCheckFailedException',
+          'The conditional request failed', 'PutItem')
+      self._store(key, copy.deepcopy(Item))
+    return {}
+
+  def get_item(self, Key, **kwargs):
+    self._call('GetItem', Key[self.hash_key])
+    with self._lock:
+      item = self.items.get(Key[self.hash_key])
+      return {'Item': copy.deepcopy(item)} if item else {}
+
+  def query(self, KeyConditionExpression, IndexName=None, **kwargs):
+    expression = KeyConditionExpression.get_expression()
+    if expression['operator'] != '=':
+      raise NotImplementedError('unsupported key condition: {}'.format(expression['operator']))
+    key_name, key_value = expression['values'][0].name, expression['values'][1]
+    self._call('Query', IndexName, key_value)
+    with self._lock:
+      if IndexName:
+        if IndexName not in self.indexes or key_name != IndexName:
+          raise client_error('ValidationException',
+            'The table does not have the specified index: {}'.format(IndexName), 'Query')
+        items = [self.items[key] for key in sorted(self.indexes[IndexName].get(key_value, ()))]
+      else:
+        items = [self.items[key_value]] if key_value in self.items else []
+      if IndexName:
+        projection = (self.hash_key, IndexName)
+        items = [{k: item[k] for k in projection if k in item} for item in items]
+      items = copy.deepcopy(items)
+    return {'Items': items, 'Count': len(items), 'ScannedCount': len(items)}
+
+  def update_item(self, Key, UpdateExpression, ExpressionAttributeValues=None,
+    ConditionExpression=None, ReturnValues='NONE', **kwargs):
+    self._call('UpdateItem', Key[self.hash_key])
+    match = re.match(r'^\s*SET\s+(.+)$', UpdateExpression)
+    if not match:
+      raise NotImplementedError('unsupported update expression: {}'.format(UpdateExpression))
+    assignments = [[part.strip() for part in assignment.split('=')]
+      for assignment in match.group(1).split(',')]
+
+    with self._lock:
+      key = Key[self.hash_key]
+      item = self.items.get(key, {})
+      if ConditionExpression is not None and not evaluate_condition(ConditionExpression, item):
+        raise client_error('ConditionalCheckFailedException',
+          'The conditional request failed', 'UpdateItem')
+      item = dict(item, **Key)
+      updated = {name: ExpressionAttributeValues[value] for name, value in assignments}
+      item.update(updated)
+      self._store(key, item)
+      attributes = copy.deepcopy(updated if ReturnValues == 'UPDATED_NEW' else item)
+    return {'Attributes': attributes} if ReturnValues != 'NONE' else {}
+
+  def delete_item(self, Key, **kwargs):
+    self._call('DeleteItem', Key[self.hash_key])
+    with self._lock:
+      self._store(Key[self.hash_key], None)
+    return {}
+
+  def _segment_of(self, key, total_segments):
+    return zlib.crc32(str(key).encode('utf-8')) % total_segments
+
+  def scan(self, FilterExpression=None, ProjectionExpression=None, Segment=0, TotalSegments=1,
+    ExclusiveStartKey=None, **kwargs):
+    self._call('Scan', Segment, TotalSegments, (ExclusiveStartKey or {}).get(self.hash_key))
+    with self._lock:
+      keys = sorted(key for key in self.items
+        if self._segment_of(key, TotalSegments) == Segment)
+      if ExclusiveStartKey:
+        keys = [key for key in keys if key > ExclusiveStartKey[self.hash_key]]
+      page = keys[:self.scan_page_size]
+      items = [self.items[key] for key in page]
+      if FilterExpression is not None:
+        items = [item for item in items if evaluate_condition(FilterExpression, item)]
+      if ProjectionExpression:
+        names = [name.strip() for name in ProjectionExpression.split(',')]
+        items = [{name: item[name] for name in names if name in item} for item in items]
+      response = {'Items': copy.deepcopy(items), 'Count': len(items), 'ScannedCount': len(page)}
+      if len(keys) > self.scan_page_size:
+        response['LastEvaluatedKey'] = {self.hash_key: page[-1]}
+    return response
+
+
+class _StreamingBody:
+
+  def __init__(self, body):
+    self._body = body
+
+  def read(self):
+    return self._body
+
+
+class FakeS3(FakeService):
+  '''In-memory S3 client with single and multipart server-side copies.'''
+
+  THROTTLING_ERROR_CODE = 'SlowDown'
+
+  def __init__(self, **kwargs):
+    super().__init__(**kwargs)
+    self.objects = {}
+    self.uploads = {}
+
+  def _get(self, bucket, key, operation_name, not_found_code='NoSuchKey'):
+    obj = self.objects.get((bucket, key))
+    if obj is None:
+      raise client_error(not_found_code, 'The specified key does not exist.', operation_name)
+    return obj
+
+  def _check_if_match(self, obj, etag, operation_name):
+    if etag is not None and obj['ETag'] != etag:
+      raise client_error('PreconditionFailed',
+        'At least one of the pre-conditions you specified did not hold', operation_name)
+
+  def store_object(self, bucket, key, body):
+    '''Store an object without latency nor throttling, e.g. Athena query results.'''
+    body = body.encode('utf-8') if isinstance(body, str) else bytes(body)
+    etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+    with self._lock:
+      self.objects[(bucket, key)] = {'Body': body, 'ETag': etag}
+    return etag
+
+  def put_object(self, Bucket, Key, Body=b'', **kwargs):
+    self._call('PutObject', Bucket, Key)
+    return {'ETag': self.store_object(Bucket, Key, Body)}
+
+  def get_object(self, Bucket, Key, **kwargs):
+    self._call('GetObject', Bucket, Key)
+    with self._lock:
+      obj = self._get(Bucket, Key, 'GetObject')
+    return {'Body': _StreamingBody(obj['Body']), 'ContentLength': len(obj['Body']), 'ETag': obj['ETag']}
+
+  def head_object(self, Bucket, Key, **kwargs):
+    self._call('HeadObject', Bucket, Key)
+    with self._lock:
+      obj = self._get(Bucket, Key, 'HeadObject', not_found_code='404')
+    return {'ContentLength': len(obj['Body']), 'ETag': obj['ETag']}
+
+  def delete_object(self, Bucket, Key, **kwargs):
+    self._call('DeleteObject', Bucket, Key)
+    with self._lock:
+      self.objects.pop((Bucket, Key), None)
+    return {}
+
+  def copy_object(self, Bucket, Key, CopySource, CopySourceIfMatch=None, **kwargs):
+    self._call('CopyObject', Bucket, Key)
+    with self._lock:
+      obj = self._get(CopySource['Bucket'], CopySource['Key'], 'CopyObject')
+      self._check_if_match(obj, CopySourceIfMatch, 'CopyObject')
+      self.objects[(Bucket, Key)] = dict(obj)
+    return {'CopyObjectResult': {'ETag': obj['ETag']}}
+
+  def create_multipart_upload(self, Bucket, Key, **kwargs):
+    rng = self._call('CreateMultipartUpload', Bucket, Key)
+    upload_id = uuid.UUID(int=rng.getrandbits(128)).hex
+    with self._lock:
+      self.uploads[upload_id] = {'Bucket': Bucket, 'Key': Key, 'Parts': {}}
+    return {'Bucket': Bucket, 'Key': Key, 'UploadId': upload_id}
+
+  def upload_part_copy(self, Bucket, Key, UploadId, PartNumber, CopySource,
+    CopySourceIfMatch=None, CopySourceRange=None, **kwargs):
+    self._call('UploadPartCopy', UploadId, PartNumber)
+    with self._lock:
+      upload = self.uploads.get(UploadId)
+      if upload is None:
+        raise client_error('NoSuchUpload', 'The specified upload does not exist.', 'UploadPartCopy')
+      obj = self._get(CopySource['Bucket'], CopySource['Key'], 'UploadPartCopy')
+      self._check_if_match(obj, CopySourceIfMatch, 'UploadPartCopy')
+      body = obj['Body']
+      if CopySourceRange:
+        start, end = [int(e) for e in CopySourceRange[len('bytes='):].split('-')]
+        body = body[start:end + 1]
+      etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+      upload['Parts'][PartNumber] = {'Body': body, 'ETag': etag}
+    return {'CopyPartResult': {'ETag': etag}}
+
+  def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+    self._call('CompleteMultipartUpload', UploadId)
+    with self._lock:
+      upload = self.uploads.pop(UploadId, None)
+      if upload is None:
+        raise client_error('NoSuchUpload', 'The specified upload does not exist.',
+          'CompleteMultipartUpload')
+      parts = MultipartUpload['Parts']
+      for part in parts:
+        uploaded = upload['Parts'].get(part['PartNumber'])
+        if uploaded is None or uploaded['ETag'] != part['ETag']:
+          raise client_error('InvalidPart', 'One or more of the specified parts could not be found.',
+            'CompleteMultipartUpload')
+      body = b''.join(upload['Parts'][part['PartNumber']]['Body'] for part in parts)
+      etag = '"{}-{}"'.format(hashlib.md5(body).hexdigest(), len(parts))
+      self.objects[(Bucket, Key)] = {'Body': body, 'ETag': etag}
+    return {'Bucket': Bucket, 'Key': Key, 'ETag': etag}
+
+  def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+    self._call('AbortMultipartUpload', UploadId)
+    with self._lock:
+      self.uploads.pop(UploadId, None)
+    return {}
+
+  def generate_presigned_url(self, ClientMethod, Params=None, ExpiresIn=3600, **kwargs):
+    #XXX: Presigning is a local operation in botocore, so it has no latency nor throttling.
+    params = Params or {}
+    return 'https://{}.s3.amazonaws.com/{}?X-Amz-Expires={}'.format(
+      params.get('Bucket'), params.get('Key'), ExpiresIn)
+
+
+class FakeSES(FakeService):
+
+  THROTTLING_ERROR_CODE = 'Throttling'
+
+  def __init__(self, **kwargs):
+    super().__init__(**kwargs)
+    self.sent_emails = []
+
+  def send_email(self, Source, Destination, Message, **kwargs):
+    self._call('SendEmail', zlib.crc32(Message['Body']['Html']['Data'].encode('utf-8')))
+    if not Source:
+      raise client_error('InvalidParameterValue', 'Missing final \'@domain\'', 'SendEmail')
+    with self._lock:
+      message_id = '{:032x}'.format(len(self.sent_emails))
+      self.sent_emails.append({
+        'MessageId': message_id,
+        'Source': Source,
+        'ToAddresses': list(Destination.get('ToAddresses', [])),
+        'Subject': Message['Subject']['Data'],
+        'Body': Message['Body']['Html']['Data']
+      })
+    return {'MessageId': message_id}
+
+
+class FakeFirehose(FakeService):
+
+  THROTTLING_ERROR_CODE = 'ServiceUnavailableException'
+
+  def __init__(self, **kwargs):
+    super().__init__(**kwargs)
+    self.records = {}
+
+  def put_record_batch(self, DeliveryStreamName, Records, **kwargs):
+    self._call('PutRecordBatch', DeliveryStreamName,
+      zlib.crc32(''.join(str(record['Data']) for record in Records).encode('utf-8')))
+    if len(Records) > 500:
+      raise client_error('InvalidArgumentException',
+        'Records has more than 500 elements', 'PutRecordBatch')
+    with self._lock:
+      stream = self.records.setdefault(DeliveryStreamName, [])
+      for record in Records:
+        data = record['Data']
+        stream.append(data.decode('utf-8') if isinstance(data, bytes) else data)
+    return {'FailedPutCount': 0, 'RequestResponses': [{'RecordId': str(i)} for i in range(len(Records))]}
+
+
+class FakeAthena(FakeService):
+  '''In-memory Athena client that simulates query lifecycles.
+
+  Every query is QUEUED for `queue_seconds`, RUNNING for `run_seconds`, and
+  then SUCCEEDED, FAILED or CANCELLED, all drawn from a random generator seeded
+  with the `ClientRequestToken` of the request, so a query gets the same id and
+  lifecycle in every run. Like Athena, a token seen before returns the same
+  query. Without a token the submission order is used instead, which is not
+  stable across concurrent submits. The states follow the virtual `clock`, and
+  a succeeded query writes a `result_size` bytes result object to the fake S3.
+  '''
+
+  THROTTLING_ERROR_CODE = 'TooManyRequestsException'
+
+  def __init__(self, clock, s3, seed=0, queue_seconds=(0, 5), run_seconds=(1, 60),
+    failure_rate=0.05, cancel_rate=0.01, result_size=1024, **kwargs):
+    super().__init__(seed=seed, **kwargs)
+    self.clock = clock
+    self.s3 = s3
+    self.seed = seed
+    self.queue_seconds = queue_seconds
+    self.run_seconds = run_seconds
+    self.failure_rate = failure_rate
+    self.cancel_rate = cancel_rate
+    self.result_size = result_size
+    self.executions = {}
+    self._query_ids_by_token = {}
+    self._sequence = 0
+
+  def _new_lifecycle(self, lifecycle_key):
+    rng = random.Random('{}-{}'.format(self.seed, lifecycle_key))
+    query_execution_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+    draw = rng.random()
+    if draw < self.failure_rate:
+      final_state = 'FAILED'
+    elif draw < self.failure_rate + self.cancel_rate:
+      final_state = 'CANCELLED'
+    else:
+      final_state = 'SUCCEEDED'
+    lifecycle = {
+      'queue_seconds': rng.uniform(*self.queue_seconds),
+      'run_seconds': rng.uniform(*self.run_seconds),
+      'final_state': final_state,
+      'data_scanned_bytes': rng.randint(0, 10 * 1024 ** 3)
+    }
+    return query_execution_id, lifecycle
+
+  def max_lifecycle_seconds(self):
+    return self.queue_seconds[1] + self.run_seconds[1]
+
+  def start_query_execution(self, QueryString, ResultConfiguration=None,
+    QueryExecutionContext=None, WorkGroup='primary', ClientRequestToken=None, **kwargs):
+    self._call('StartQueryExecution', ClientRequestToken)
+    if not QueryString:
+      raise client_error('InvalidRequestException', 'QueryString is empty', 'StartQueryExecution')
+    output_location = (ResultConfiguration or {}).get('OutputLocation')
+    if not output_location:
+      raise client_error('InvalidRequestException',
+        'No output location provided', 'StartQueryExecution')
+
+    with self._lock:
+      if ClientRequestToken in self._query_ids_by_token:
+        return {'QueryExecutionId': self._query_ids_by_token[ClientRequestToken]}
+      self._sequence += 1
+      query_execution_id, lifecycle = self._new_lifecycle(ClientRequestToken or self._sequence)
+      if ClientRequestToken:
+        self._query_ids_by_token[ClientRequestToken] = query_execution_id
+      self.executions[query_execution_id] = {
+        'QueryExecution': {
+          'QueryExecutionId': query_execution_id,
+          'Query': QueryString,
+          'StatementType': 'DML',
+          'ResultConfiguration': {
+            'OutputLocation': '{}/{}.csv'.format(output_location.rstrip('/'), query_execution_id)
+          },
+          'QueryExecutionContext': copy.deepcopy(QueryExecutionContext or {}),
+          'Status': {'State': 'QUEUED'},
+          'WorkGroup': WorkGroup
+        },
+        'submitted_at': self.clock.now(),
+        'lifecycle': lifecycle,
+        'reported_states': ['QUEUED']
+      }
+    return {'QueryExecutionId': query_execution_id}
+
+  def _refresh(self, execution):
+    query_execution, lifecycle = execution['QueryExecution'], execution['lifecycle']
+    status = query_execution['Status']
+    if status['State'] in ('SUCCEEDED', 'FAILED', 'CANCELLED'):
+      return
+
+    submitted_at = execution['submitted_at']
+    elapsed = self.clock.now() - submitted_at
+    status['SubmissionDateTime'] = self.clock.to_datetime(submitted_at)
+    if elapsed < lifecycle['queue_seconds']:
+      return
+    status['State'] = 'RUNNING'
+    if elapsed < lifecycle['queue_seconds'] + lifecycle['run_seconds']:
+      return
+
+    status['State'] = lifecycle['final_state']
+    status['CompletionDateTime'] = self.clock.to_datetime(
+      submitted_at + lifecycle['queue_seconds'] + lifecycle['run_seconds'])
+    if status['State'] == 'FAILED':
+      status['StateChangeReason'] = 'SYNTAX_ERROR: simulated failure'
+    queue_ms = int(lifecycle['queue_seconds'] * 1000)
+    run_ms = int(lifecycle['run_seconds'] * 1000)
+    query_execution['Statistics'] = {
+      'QueryQueueTimeInMillis': queue_ms,
+      'QueryPlanningTimeInMillis': run_ms // 10,
+      'EngineExecutionTimeInMillis': run_ms,
+      'ServiceProcessingTimeInMillis': 10,
+      'TotalExecutionTimeInMillis': queue_ms + run_ms + 10,
+      'DataScannedInBytes': lifecycle['data_scanned_bytes']
+    }
+    if status['State'] == 'SUCCEEDED':
+      output_location = query_execution['ResultConfiguration']['OutputLocation']
+      bucket, _, key = output_location[len('s3://'):].partition('/')
+      body = ('"dt","impressionid"\n' * (self.result_size // 20 + 1))[:self.result_size]
+      self.s3.store_object(bucket, key, body)
+
+  def _get_execution(self, query_execution_id):
+    execution = self.executions.get(query_execution_id)
+    if execution is not None:
+      self._refresh(execution)
+    return execution
+
+  def get_query_execution(self, QueryExecutionId):
+    self._call('GetQueryExecution', QueryExecutionId)
+    with self._lock:
+      execution = self._get_execution(QueryExecutionId)
+      if execution is None:
+        raise client_error('InvalidRequestException',
+          'QueryExecution {} was not found'.format(QueryExecutionId), 'GetQueryExecution')
+      return {'QueryExecution': copy.deepcopy(execution['QueryExecution'])}
+
+  def batch_get_query_execution(self, QueryExecutionIds):
+    self._call('BatchGetQueryExecution', *QueryExecutionIds[:1])
+    if not 1 <= len(QueryExecutionIds) <= 50:
+      raise client_error('InvalidRequestException',
+        'QueryExecutionIds must have between 1 and 50 items', 'BatchGetQueryExecution')
+    query_executions, unprocessed_query_ids = [], []
+    with self._lock:
+      for query_execution_id in QueryExecutionIds:
+        execution = self._get_execution(query_execution_id)
+        if execution is None:
+          unprocessed_query_ids.append({
+            'QueryExecutionId': query_execution_id,
+            'ErrorCode': 'INVALID_INPUT',
+            'ErrorMessage': 'QueryExecution {} was not found'.format(query_execution_id)
+          })
+        else:
+          query_executions.append(copy.deepcopy(execution['QueryExecution']))
+    return {'QueryExecutions': query_executions, 'UnprocessedQueryExecutionIds': unprocessed_query_ids}
+
+  def pop_state_change_events(self):
+    '''Return the `Athena Query State Change` events since the last call.
+
+    Events are built like EventBridge ones, one per state transition.
+    '''
+    events = []
+    with self._lock:
+      for query_execution_id, execution in self.executions.items():
+        self._refresh(execution)
+        state = execution['QueryExecution']['Status']['State']
+        reported_states = execution['reported_states']
+        if reported_states[-1] == state:
+          continue
+        transitions = ['RUNNING', state] if reported_states[-1] == 'QUEUED' and state != 'RUNNING' else [state]
+        for current_state in transitions:
+          events.append({
+            'id': str(uuid.uuid5(uuid.NAMESPACE_URL, '{}/{}'.format(query_execution_id, current_state))),
+            'detail': {
+              'currentState': current_state,
+              'previousState': reported_states[-1],
+              'queryExecutionId': query_execution_id,
+              'workgroupName': execution['QueryExecution']['WorkGroup']
+            },
+            'detail-type': 'Athena Query State Change',
+            'source': 'aws.athena'
+          })
+          reported_states.append(current_state)
+    return events
+
+
+class FakeBackend:
+  '''In-memory replacement of `aws_backends.Boto3Backend`.
+
+  Install it with `aws_backends.set_backend(FakeBackend(...))`. Region names
+  and endpoint urls are ignored; every service shares the same `latency_ms`
+  and `throttle_rate`.
+  '''
+
+  def __init__(self, seed=0, latency_ms=(0, 0), throttle_rate=0.0, **athena_kwargs):
+    service_kwargs = {'latency_ms': latency_ms, 'throttle_rate': throttle_rate}
+    self._lock = threading.Lock()
+    self._seed = seed
+    self._service_kwargs = service_kwargs
+    self.clock = FakeClock()
+    self.s3_service = FakeS3(seed=seed + 1, **service_kwargs)
+    self.ses_service = FakeSES(seed=seed + 2, **service_kwargs)
+    self.firehose_service = FakeFirehose(seed=seed + 3, **service_kwargs)
+    self.athena_service = FakeAthena(self.clock, self.s3_service, seed=seed,
+      **dict(service_kwargs, **athena_kwargs))
+    self.tables = {}
+
+  def utcnow(self):
+    #XXX: Same naive UTC datetime as `datetime.datetime.utcnow()`
+    return self.clock.to_datetime(self.clock.now()).replace(tzinfo=None)
+
+  def athena(self, region_name):
+    return self.athena_service
+
+  def dynamodb_table(self, table_name, region_name):
+    with self._lock:
+      if table_name not in self.tables:
+        self.tables[table_name] = FakeDynamoDBTable(table_name,
+          seed=self._seed + 4 + len(self.tables), **self._service_kwargs)
+      return self.tables[table_name]
+
+  def s3(self, region_name, endpoint_url=None):
+    return self.s3_service
+
+  def ses(self, region_name):
+    return self.ses_service
+
+  def firehose(self, region_name):
+    return self.firehose_service
+
+  def services(self):
+    services = [('athena', self.athena_service), ('s3', self.s3_service),
+      ('ses', self.ses_service), ('firehose', self.firehose_service)]
+    services.extend(('dynamodb:{}'.format(name), table) for name, table in sorted(self.tables.items()))
+    return services
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+#vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+'''Replay queries through the whole submit -> event -> notify pipeline.
+
+The handlers run unchanged against the in-memory fakes of `fake_aws_backends`:
+the CommandHander submits the queries in waves spread over a virtual clock, the
+fake Athena plays the query lifecycles on the same clock, and the resulting
+`Athena Query State Change` events are dispatched to the QueryResultsHandler
+while the QueryStatusSweeper runs, so both paths race for the stale queries.
+The sweeper must leave the queries younger than its staleness threshold alone;
+a second sweep after the threshold picks up the rest of the dropped events.
+At the end the tracking rows, emails and query history records are checked
+against the final Athena query states.
+'''
+
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+SRC_MAIN_PYTHON = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'main', 'python')
+for module_dir in ('CommonLayer/python', 'CommandHander', 'QueryResultsHandler'):
+  sys.path.insert(0, os.path.normpath(os.path.join(SRC_MAIN_PYTHON, module_dir)))
+
+import aws_backends
+import command_handler
+import query_results_handler
+import query_status_sweeper
+import results_delivery
+
+from fake_aws_backends import FakeBackend
+
+QUERY_OUTPUT_BUCKET_NAME = 'aws-athena-cqrs-workspace-simulation'
+DDB_TABLE_NAME = 'AthenaQueryStatusPerUser'
+EMAIL_FROM_ADDRESS = 'sender@example.com'
+QUERY_HISTORY_DELIVERY_STREAM_NAME = 'AthenaQueryHistory'
+
+QUERY_STRING = '''SELECT dt, impressionid
+FROM impressions
+WHERE dt <  '2009-04-12-14-00'
+  AND dt >= '2009-04-12-13-00'
+ORDER BY  dt DESC LIMIT 100'''
+
+QUERY_ID_IN_EMAIL = re.compile(r'<td>query_id</th>\s*<td>([0-9a-f-]+)</td>')
+
+
+def percentiles(latencies, pcts=(50, 95, 99)):
+  if not latencies:
+    return {p: 0.0 for p in pcts}
+  latencies = sorted(latencies)
+  return {p: latencies[min(len(latencies) - 1, int(len(latencies) * p / 100.0))] for p in pcts}
+
+
+def run_concurrently(fn, args, concurrency):
+  '''Call `fn` for every arg on `concurrency` threads.
+
+  Returns a list of (arg, result, exception, latency seconds) and the wall time.
+  '''
+  def _timed(arg):
+    started_at = time.perf_counter()
+    try:
+      result, exception = fn(arg), None
+    except Exception as ex:
+      result, exception = None, ex
+    return arg, result, exception, time.perf_counter() - started_at
+
+  started_at = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=concurrency) as executor:
+    outcomes = list(executor.map(_timed, args))
+  return outcomes, time.perf_counter() - started_at
+
+
+def print_phase(name, outcomes, elapsed):
+  latencies_ms = [latency * 1000 for _, _, _, latency in outcomes]
+  pcts = percentiles(latencies_ms)
+  print('{:<10} {:>6} calls {:>9.1f} calls/s  p50 {:>7.2f} ms  p95 {:>7.2f} ms  p99 {:>7.2f} ms'.format(
+    name, len(outcomes), len(outcomes) / elapsed if elapsed else 0.0, pcts[50], pcts[95], pcts[99]))
+
+
+def build_command_event(user_id, client_request_token):
+  req_body = {
+    'QueryString': QUERY_STRING,
+    'ClientRequestToken': client_request_token,
+    'QueryExecutionContext': {'Database': 'hive_ads'},
+    'ResultConfiguration': {'OutputLocation': 's3://{}/query-results/'.format(QUERY_OUTPUT_BUCKET_NAME)}
+  }
+  return {
+    'resource': '/',
+    'path': '/',
+    'httpMethod': 'POST',
+    'queryStringParameters': {'user': user_id},
+    'body': json.dumps(req_body),
+    'isBase64Encoded': False
+  }
+
+
+def configure_handlers(options):
+  command_handler.ATHENA_QUERY_OUTPUT_BUCKET_NAME = QUERY_OUTPUT_BUCKET_NAME
+  command_handler.ATHENA_WORK_GROUP_NAME = 'primary'
+  command_handler.DDB_TABLE_NAME = DDB_TABLE_NAME
+
+  query_results_handler.DDB_TABLE_NAME = DDB_TABLE_NAME
+  query_results_handler.EMAIL_FROM_ADDRESS = EMAIL_FROM_ADDRESS
+  query_results_handler.QUERY_HISTORY_DELIVERY_STREAM_NAME = QUERY_HISTORY_DELIVERY_STREAM_NAME
+
+  query_status_sweeper.DDB_TABLE_NAME = DDB_TABLE_NAME
+  query_status_sweeper.STALE_QUERY_MINUTES = options.stale_minutes
+  query_status_sweeper.SCAN_TOTAL_SEGMENTS = options.scan_segments
+
+  if options.deliver_to:
+    results_delivery.RESULTS_DELIVERY_TARGETS = {'@example.com': options.deliver_to}
+    results_delivery.RESULTS_DELIVERY_PART_SIZE = options.delivery_part_size
+    #XXX: The fake S3 has no minimum part size, so small results still go through UploadPartCopy.
+    results_delivery.MIN_PART_SIZE = 1
+
+
+def get_emails_by_query_id(backend):
+  emails_by_query_id = {}
+  for email in backend.ses_service.sent_emails:
+    match = QUERY_ID_IN_EMAIL.search(email['Body'])
+    if match:
+      emails_by_query_id.setdefault(match.group(1), []).append(email)
+  return emails_by_query_id
+
+
+def get_history_records(backend):
+  return [json.loads(data) for data in
+    backend.firehose_service.records.get(QUERY_HISTORY_DELIVERY_STREAM_NAME, [])]
+
+
+def verify_fresh_queries(backend, fresh_query_ids):
+  '''Check that the sweeper left the dropped events of fresh queries alone.'''
+  table = backend.tables[DDB_TABLE_NAME]
+  emails_by_query_id = get_emails_by_query_id(backend)
+  history_query_ids = {record['query_id'] for record in get_history_records(backend)}
+
+  errors = []
+  for query_id, user_id in fresh_query_ids.items():
+    row = table.items.get(user_id, {})
+    if row.get('query_id') == query_id and row.get('query_status') not in ('QUEUED', 'RUNNING'):
+      errors.append('{}: fresh query swept to {}'.format(query_id, row.get('query_status')))
+    if query_id in emails_by_query_id or query_id in history_query_ids:
+      errors.append('{}: fresh query completed without an event'.format(query_id))
+  return errors
+
+
+def verify(backend, submitted, options):
+  athena, ses = backend.athena_service, backend.ses_service
+  table = backend.tables[DDB_TABLE_NAME]
+
+  final_states = {query_id: execution['QueryExecution']['Status']['State']
+    for query_id, execution in athena.executions.items()}
+  emails_by_query_id = get_emails_by_query_id(backend)
+  history_records = get_history_records(backend)
+  history_counts = {}
+  for record in history_records:
+    history_counts[record['query_id']] = history_counts.get(record['query_id'], 0) + 1
+
+  errors, superseded, misrouted, lost = [], 0, 0, 0
+  superseded_query_ids = set()
+  for query_id, user_id in submitted.items():
+    final_state = final_states[query_id]
+    row = table.items.get(user_id, {})
+    #XXX: The tracking table is keyed by user_id only, so a newer query of the same user replaces the row.
+    is_superseded = row.get('query_id') != query_id
+    superseded += int(is_superseded)
+    if is_superseded:
+      superseded_query_ids.add(query_id)
+
+    if not is_superseded and row.get('query_status') != final_state:
+      errors.append('{}: tracking row is {}, athena is {}'.format(query_id, row.get('query_status'), final_state))
+
+    emails = emails_by_query_id.get(query_id, [])
+    expected_emails = 1 if final_state == 'SUCCEEDED' else 0
+    history_count = history_counts.get(query_id, 0)
+    if is_superseded and history_count == 0:
+      #XXX: The sweeper cannot find a superseded query whose event was dropped.
+      lost += 1
+      continue
+    if len(emails) != expected_emails:
+      errors.append('{}: {} emails for a {} query'.format(query_id, len(emails), final_state))
+    elif emails and emails[0]['ToAddresses'] != [user_id]:
+      misrouted += 1
+      if not is_superseded:
+        errors.append('{}: email sent to {} instead of {}'.format(query_id, emails[0]['ToAddresses'], user_id))
+
+    if history_count != 1:
+      errors.append('{}: {} query history records'.format(query_id, history_count))
+
+  if options.deliver_to:
+    dst_bucket = options.deliver_to[len('s3://'):].partition('/')[0]
+    delivered = sum(1 for bucket, _ in backend.s3_service.objects if bucket == dst_bucket)
+    #XXX: The requester of a superseded query is unknown, so its results are not delivered.
+    succeeded = sum(1 for query_id in submitted
+      if final_states[query_id] == 'SUCCEEDED' and query_id not in superseded_query_ids)
+    if delivered != succeeded:
+      errors.append('{} results delivered for {} succeeded queries'.format(delivered, succeeded))
+
+  state_counts = {}
+  for query_id in submitted:
+    state_counts[final_states[query_id]] = state_counts.get(final_states[query_id], 0) + 1
+  print('final states: {}'.format(json.dumps(state_counts, sort_keys=True)))
+  print('emails: {}  history records: {}  superseded rows: {}  misrouted emails: {}  lost: {}'.format(
+    len(ses.sent_emails), len(history_records), superseded, misrouted, lost))
+  return errors
+
+
+def invoke_async(handler, event, retry_attempts=2):
+  '''Call `handler` like an asynchronous invocation, which Lambda retries twice on an error.'''
+  for attempt in range(retry_attempts + 1):
+    try:
+      return handler(event, {})
+    except Exception:
+      if attempt == retry_attempts:
+        raise
+
+
+def check_sweep(name, outcomes, elapsed):
+  print_phase(name, outcomes, elapsed)
+  _, summary, exception, _ = outcomes[0]
+  if exception:
+    return ['{}: {}'.format(name, repr(exception))]
+  print('sweeper: {}'.format(json.dumps(summary, sort_keys=True)))
+  return ['{}: {} errors'.format(name, summary['errors'])] if summary['errors'] else []
+
+
+def main(options):
+  backend = FakeBackend(seed=options.seed,
+    latency_ms=(options.min_latency_ms, options.max_latency_ms),
+    throttle_rate=options.throttle_rate,
+    failure_rate=options.failure_rate,
+    cancel_rate=options.cancel_rate,
+    result_size=options.result_size)
+  aws_backends.set_backend(backend)
+  configure_handlers(options)
+
+  # 1. submit queries through the CommandHander, one wave every `wave_interval_minutes`
+  #XXX: The ClientRequestToken of a submit decides its query id and lifecycle in the fake Athena,
+  # so the same seed replays the same queries however the submits interleave.
+  requests = [('user{}@example.com'.format(i % options.users),
+    uuid.uuid5(uuid.NAMESPACE_URL, 'simulate_pipeline/{}/{}'.format(options.seed, i)).hex)
+    for i in range(options.queries)]
+  waves = [requests[i::options.waves] for i in range(options.waves)]
+  outcomes, elapsed = [], 0.0
+  for i, wave in enumerate(waves):
+    if i > 0:
+      backend.clock.advance(options.wave_interval_minutes * 60)
+    wave_outcomes, wave_elapsed = run_concurrently(
+      lambda request: command_handler.lambda_handler(build_command_event(*request), {}),
+      wave, options.concurrency)
+    outcomes.extend(wave_outcomes)
+    elapsed += wave_elapsed
+  print_phase('submit', outcomes, elapsed)
+
+  submitted, errors = {}, []
+  for (user_id, _), response, exception, _ in outcomes:
+    if exception or response['statusCode'] != 200:
+      errors.append('submit {}: {}'.format(user_id, repr(exception) if exception else response))
+      continue
+    submitted[json.loads(response['body'])['QueryExecutionId']] = user_id
+
+  # 2. play the query lifecycles and dispatch the events that match AthenaQueryExecutionRule,
+  # while the sweeper reconciles the queries older than `stale_minutes`
+  backend.clock.advance(backend.athena_service.max_lifecycle_seconds() + 1)
+  events = [event for event in backend.athena_service.pop_state_change_events()
+    if event['detail']['previousState'] == 'RUNNING']
+  delivered_events = [event for event in events
+    if random.Random('{}-{}'.format(options.seed, event['detail']['queryExecutionId'])).random()
+      >= options.drop_event_rate]
+
+  submitted_at = {query_id: execution['submitted_at']
+    for query_id, execution in backend.athena_service.executions.items()}
+  stale_query_ids = {query_id for query_id in submitted
+    if backend.clock.now() - submitted_at[query_id] > options.stale_minutes * 60}
+  delivered_query_ids = {event['detail']['queryExecutionId'] for event in delivered_events}
+  print('raced: {} stale queries with a delivered event'.format(len(stale_query_ids & delivered_query_ids)))
+  fresh_query_ids = {query_id: user_id for query_id, user_id in submitted.items()
+    if query_id not in stale_query_ids and query_id not in delivered_query_ids}
+
+  with ThreadPoolExecutor(max_workers=1) as sweeper:
+    sweep = sweeper.submit(run_concurrently,
+      lambda _: query_status_sweeper.lambda_handler({}, {}), [None], 1)
+    outcomes, elapsed = run_concurrently(
+      lambda event: invoke_async(query_results_handler.lambda_handler, event),
+      delivered_events, options.concurrency)
+    sweep_outcomes, sweep_elapsed = sweep.result()
+  print_phase('notify', outcomes, elapsed)
+  for event, _, exception, _ in outcomes:
+    if exception:
+      errors.append('notify {}: {}'.format(event['detail']['queryExecutionId'], repr(exception)))
+  print('events: {} dropped of {}'.format(len(events) - len(delivered_events), len(events)))
+  #XXX: A query the sweeper fails to complete stays stale, so its errors are retried by the next sweep.
+  check_sweep('sweep', sweep_outcomes, sweep_elapsed)
+  errors.extend(verify_fresh_queries(backend, fresh_query_ids))
+
+  # 3. reconcile the rest of the dropped events once they are stale
+  backend.clock.advance(options.stale_minutes * 60 + 1)
+  outcomes, elapsed = run_concurrently(lambda _: query_status_sweeper.lambda_handler({}, {}),
+    [None], 1)
+  errors.extend(check_sweep('sweep', outcomes, elapsed))
+
+  for name, service in backend.services():
+    print('{:<34} calls {:>7}  throttled {:>5}'.format(name, sum(service.calls.values()), service.throttled))
+
+  errors.extend(verify(backend, submitted, options))
+  for error in errors[:20]:
+    print('ERROR {}'.format(error))
+  print('{} errors'.format(len(errors)))
+  return 1 if errors else 0
+
+
+if __name__ == '__main__':
+  import argparse
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--queries', type=int, default=2000,
+    help='number of queries to replay: default=2000')
+  parser.add_argument('--users', type=int, default=None,
+    help='number of distinct users: default=one per query')
+  parser.add_argument('--concurrency', type=int, default=32,
+    help='number of concurrent handler invocations: default=32')
+  parser.add_argument('--seed', type=int, default=0,
+    help='random seed: default=0')
+  parser.add_argument('--min-latency-ms', type=float, default=0.0,
+    help='minimum latency of a fake aws call in ms: default=0')
+  parser.add_argument('--max-latency-ms', type=float, default=2.0,
+    help='maximum latency of a fake aws call in ms: default=2')
+  parser.add_argument('--throttle-rate', type=float, default=0.01,
+    help='probability that a fake aws call is throttled: default=0.01')
+  parser.add_argument('--failure-rate', type=float, default=0.05,
+    help='probability that a query fails: default=0.05')
+  parser.add_argument('--cancel-rate', type=float, default=0.01,
+    help='probability that a query is cancelled: default=0.01')
+  parser.add_argument('--drop-event-rate', type=float, default=0.05,
+    help='probability that a query state change event is lost: default=0.05')
+  parser.add_argument('--waves', type=int, default=4,
+    help='number of submission waves: default=4')
+  parser.add_argument('--wave-interval-minutes', type=float, default=15,
+    help='virtual minutes between submission waves: default=15')
+  parser.add_argument('--stale-minutes', type=int, default=30,
+    help='staleness threshold in minutes of the sweeper: default=30')
+  parser.add_argument('--scan-segments', type=int, default=4,
+    help='number of parallel scan segments of the sweeper: default=4')
+  parser.add_argument('--result-size', type=int, default=1024,
+    help='size of a query result object in bytes: default=1024')
+  parser.add_argument('--deliver-to', default=None,
+    help='deliver the results of every user to this location. ex) s3://team-bucket/results/')
+  parser.add_argument('--delivery-part-size', type=int, default=256,
+    help='multipart copy part size in bytes of the results delivery: default=256')
+  parser.add_argument('--log-level', default='CRITICAL',
+    help='log level of the handlers: default=CRITICAL')
+
+  options = parser.parse_args()
+  if options.users is None:
+    options.users = options.queries
+
+  #XXX: The handlers log every FAILED query as an error; the outcomes are checked instead.
+  logging.getLogger().setLevel(options.log_level)
+  sys.exit(main(options))
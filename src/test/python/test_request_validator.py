@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+#vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import os
+import sys
+import json
+import base64
+
+import pytest
+
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+  '..', '..', 'main', 'python', 'CommandHander')))
+
+import request_validator
+from request_validator import (
+  MAX_BODY_BYTES,
+  MAX_QUERY_STRING_BYTES,
+  ValidationError,
+  validate_request
+)
+
+USER_ID = 'xyz@example.com'
+
+REQ_BODY = {
+  'QueryString': 'SELECT dt, impressionid FROM impressions LIMIT 100',
+  'QueryExecutionContext': {'Database': 'hive_ads'},
+  'ResultConfiguration': {'OutputLocation': 's3://bucket-name/query-results/'}
+}
+
+
+def make_event(body=None, user=USER_ID, is_base64_encoded=False, **kwargs):
+  event = {
+    'httpMethod': 'POST',
+    'body': json.dumps(REQ_BODY) if body is None else body,
+    'isBase64Encoded': is_base64_encoded,
+    'queryStringParameters': {'user': user} if user is not None else None
+  }
+  event.update(kwargs)
+  return event
+
+
+def make_body(**kwargs):
+  req_body = dict(REQ_BODY, **kwargs)
+  return json.dumps({k: v for k, v in req_body.items() if v is not None}, ensure_ascii=False)
+
+
+VALID_CASES = [
+  ('minimal', make_event()),
+  ('base64 body', make_event(body=base64.b64encode(json.dumps(REQ_BODY).encode('utf-8')).decode('ascii'),
+    is_base64_encoded=True)),
+  ('all optional fields', make_event(body=make_body(
+    ClientRequestToken='0' * 32,
+    WorkGroup='primary',
+    ExecutionParameters=['1', "'a'"],
+    ResultConfiguration={
+      'OutputLocation': 's3://bucket-name/query-results/',
+      'EncryptionConfiguration': {'EncryptionOption': 'SSE_KMS', 'KmsKey': 'alias/athena'},
+      'ExpectedBucketOwner': '111122223333',
+      'AclConfiguration': {'S3AclOption': 'BUCKET_OWNER_FULL_CONTROL'}
+    },
+    ResultReuseConfiguration={'ResultReuseByAgeConfiguration': {'Enabled': True, 'MaxAgeInMinutes': 60}}
+  ))),
+  ('non-ascii query string', make_event(body=make_body(QueryString="SELECT '한글' AS k"))),
+]
+
+INVALID_CASES = [
+  # (name, event, status_code, error message)
+  ('missing body', make_event(body=''), 400, 'body: must be at least 1 characters'),
+  ('null body', dict(make_event(), body=None), 400, 'body: is required'),
+  ('missing user', make_event(user=None), 400, 'queryStringParameters: is required'),
+  ('invalid user', make_event(user='xyz'), 400, 'queryStringParameters.user: must match'),
+  ('user with trailing newline', make_event(user=USER_ID + '\n'), 400, 'queryStringParameters.user: must match'),
+  ('invalid json', make_event(body='{"QueryString": '), 400, 'body: invalid json'),
+  ('not an object', make_event(body='[]'), 400, 'body: must be object'),
+  ('missing QueryString', make_event(body=make_body(QueryString=None)), 400,
+    'body.QueryString: is required'),
+  ('missing OutputLocation', make_event(body=make_body(ResultConfiguration={})), 400,
+    'body.ResultConfiguration.OutputLocation: is required'),
+  ('invalid OutputLocation', make_event(body=make_body(ResultConfiguration={'OutputLocation': 'bucket-name/'})),
+    400, 'body.ResultConfiguration.OutputLocation: must match'),
+  ('unknown key', make_event(body=make_body(Foo='bar')), 400, 'body.Foo: is not allowed'),
+  ('unknown nested key', make_event(body=make_body(QueryExecutionContext={'Database': 'a', 'Foo': 'b'})),
+    400, 'body.QueryExecutionContext.Foo: is not allowed'),
+  ('wrong type', make_event(body=make_body(QueryString=1)), 400, 'body.QueryString: must be string'),
+  ('bucket owner with trailing newline', make_event(body=make_body(ResultConfiguration={
+      'OutputLocation': 's3://bucket-name/', 'ExpectedBucketOwner': '111122223333\n'})),
+    400, 'body.ResultConfiguration.ExpectedBucketOwner: must match'),
+  ('invalid enum', make_event(body=make_body(ResultConfiguration={
+      'OutputLocation': 's3://bucket-name/',
+      'EncryptionConfiguration': {'EncryptionOption': 'AES'}})),
+    400, 'body.ResultConfiguration.EncryptionConfiguration.EncryptionOption: must be one of'),
+  ('invalid array item', make_event(body=make_body(ExecutionParameters=['1', 2])), 400,
+    'body.ExecutionParameters[1]: must be string'),
+  ('bool is not integer', make_event(body=make_body(ResultReuseConfiguration={
+      'ResultReuseByAgeConfiguration': {'Enabled': True, 'MaxAgeInMinutes': True}})),
+    400, 'body.ResultReuseConfiguration.ResultReuseByAgeConfiguration.MaxAgeInMinutes: must be integer'),
+  ('bad base64', make_event(body='not base64!', is_base64_encoded=True), 400,
+    'body: invalid base64 encoding'),
+  ('oversize body', make_event(body=' ' * (MAX_BODY_BYTES + 1)), 413,
+    'body: must be at most {} bytes'.format(MAX_BODY_BYTES)),
+  ('oversize non-ascii body', make_event(body='"{}"'.format('é' * (MAX_BODY_BYTES // 2 + 1))), 413,
+    'body: must be at most {} bytes'.format(MAX_BODY_BYTES)),
+  ('oversize query string', make_event(body=make_body(QueryString='한' * (MAX_QUERY_STRING_BYTES // 3 + 1))),
+    413, 'body.QueryString: must be at most {} bytes'.format(MAX_QUERY_STRING_BYTES)),
+  ('deep nesting', make_event(body='[' * 200000), 400, 'body: too deeply nested json'),
+  ('deep nesting in ExecutionParameters',
+    make_event(body='{{"ExecutionParameters": {}'.format('[' * 200000)), 400,
+    'body: too deeply nested json'),
+]
+
+
+@pytest.mark.parametrize('name, event', VALID_CASES, ids=[case[0] for case in VALID_CASES])
+def test_validate_request_accepts(name, event):
+  query, user_id = validate_request(event)
+  assert user_id == USER_ID
+  assert query['ResultConfiguration']['OutputLocation'].startswith('s3://')
+
+
+@pytest.mark.parametrize('name, event, status_code, message', INVALID_CASES,
+  ids=[case[0] for case in INVALID_CASES])
+def test_validate_request_rejects(name, event, status_code, message):
+  with pytest.raises(ValidationError) as exc_info:
+    validate_request(event)
+  assert exc_info.value.status_code == status_code
+  assert str(exc_info.value).startswith(message)
+
+
+def test_compile_schema_reports_first_invalid_path():
+  validate = request_validator.compile_schema({
+    'type': 'object',
+    'required': ['a'],
+    'properties': {'a': {'type': 'array', 'minItems': 1, 'items': {'type': 'integer', 'minimum': 0}}}
+  })
+  assert validate({'a': [0, 1]}) == {'a': [0, 1]}
+  with pytest.raises(ValidationError) as exc_info:
+    validate({'a': [0, -1]}, 'root')
+  assert exc_info.value.path == 'root.a[1]'
+  assert str(exc_info.value) == 'root.a[1]: must be >= 0'
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+#vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import os
+import sys
+import json
+import time
+
+import pytest
+
+#XXX: results_delivery raises botocore errors and gets its client from aws_backends.
+pytest.importorskip('boto3')
+
+SRC_MAIN_PYTHON = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'main', 'python')
+for module_dir in ('CommonLayer/python', 'QueryResultsHandler'):
+  sys.path.insert(0, os.path.normpath(os.path.join(SRC_MAIN_PYTHON, module_dir)))
+
+import botocore.exceptions
+
+import aws_backends
+import query_results_handler
+import results_delivery
+from results_delivery import (
+  CHECKPOINT_SUFFIX,
+  MAX_COPY_OBJECT_SIZE,
+  MAX_PART_COUNT,
+  MIN_PART_SIZE,
+  DeliveryIncompleteError,
+  deliver_object,
+  get_part_size
+)
+
+from fake_aws_backends import FakeBackend, FakeS3, client_error
+
+SRC_BUCKET, SRC_KEY = 'query-results-bucket', 'query-results/query-id.csv'
+DST_BUCKET, DST_KEY = 'team-bucket', 'results/query-id.csv'
+CHECKPOINT_KEY = SRC_KEY + CHECKPOINT_SUFFIX
+BODY = bytes(range(256)) * 4
+PART_SIZE = 100
+PART_COUNT = 11
+
+
+@pytest.fixture
+def s3(monkeypatch):
+  #XXX: The fake S3 has no minimum part size, so a small object still goes through UploadPartCopy.
+  monkeypatch.setattr(results_delivery, 'MIN_PART_SIZE', 1)
+  s3 = FakeS3()
+  s3.store_object(SRC_BUCKET, SRC_KEY, BODY)
+  return s3
+
+
+def intercept_parts(s3, failures=None, before=None):
+  '''Record the part numbers passed to `upload_part_copy`.
+
+  A part number in `failures` raises a ClientError with the mapped error code,
+  and `before(part_number)` runs before every part is copied.
+  '''
+  failures = failures or {}
+  #XXX: Wrap the method of the class, so a later call replaces an earlier interception.
+  upload_part_copy = FakeS3.upload_part_copy.__get__(s3)
+  attempted = []
+  def _upload_part_copy(**kwargs):
+    part_number = kwargs['PartNumber']
+    attempted.append(part_number)
+    if before:
+      before(part_number)
+    if part_number in failures:
+      raise client_error(failures[part_number], 'simulated failure', 'UploadPartCopy')
+    return upload_part_copy(**kwargs)
+  s3.upload_part_copy = _upload_part_copy
+  return attempted
+
+
+def load_checkpoint(s3):
+  obj = s3.objects.get((SRC_BUCKET, CHECKPOINT_KEY))
+  return json.loads(obj['Body']) if obj else None
+
+
+def deliver(s3, **kwargs):
+  kwargs.setdefault('part_size', PART_SIZE)
+  kwargs.setdefault('max_workers', 1)
+  return deliver_object(s3, SRC_BUCKET, SRC_KEY, DST_BUCKET, DST_KEY, **kwargs)
+
+
+@pytest.mark.parametrize('object_size, part_size, expected', [
+  (100 * 1024 * 1024, 1, MIN_PART_SIZE),
+  (MAX_PART_COUNT * 6 * 1024 ** 2 + 1, MIN_PART_SIZE, 6 * 1024 ** 2 + 1),
+  (MAX_PART_COUNT * 6 * 1024 ** 3, 128 * 1024 * 1024, MAX_COPY_OBJECT_SIZE),
+  (1024 ** 3, 10 * 1024 ** 3, MAX_COPY_OBJECT_SIZE),
+], ids=['minimum', 'part count limit', 'copy size limit', 'large part size'])
+def test_get_part_size(object_size, part_size, expected):
+  assert get_part_size(object_size, part_size) == expected
+
+
+def test_small_object_uses_copy_object(s3):
+  assert deliver(s3, part_size=len(BODY)) == (DST_BUCKET, DST_KEY)
+  assert s3.objects[(DST_BUCKET, DST_KEY)]['Body'] == BODY
+  assert s3.calls.get('CreateMultipartUpload', 0) == 0
+
+
+@pytest.mark.parametrize('move', [False, True], ids=['copy', 'move'])
+def test_multipart_copy(s3, move):
+  attempted = intercept_parts(s3)
+  deliver(s3, move=move, max_workers=4)
+  assert s3.objects[(DST_BUCKET, DST_KEY)]['Body'] == BODY
+  assert sorted(attempted) == list(range(1, PART_COUNT + 1))
+  assert ((SRC_BUCKET, SRC_KEY) in s3.objects) is not move
+  assert load_checkpoint(s3) is None
+  assert s3.uploads == {}
+
+
+def test_deadline_saves_checkpoint_and_resumes(s3):
+  attempted = intercept_parts(s3)
+  with pytest.raises(DeliveryIncompleteError):
+    deliver(s3, deadline=time.time() - 1)
+  checkpoint = load_checkpoint(s3)
+  assert checkpoint['parts'] == {}
+  assert checkpoint['upload_id'] in s3.uploads
+  assert attempted == []
+
+  deliver(s3)
+  assert s3.objects[(DST_BUCKET, DST_KEY)]['Body'] == BODY
+  assert s3.calls['CreateMultipartUpload'] == 1
+  assert load_checkpoint(s3) is None
+
+
+def test_failed_part_stops_queued_parts_and_resumes(s3):
+  attempted = intercept_parts(s3, failures={3: 'InternalError'})
+  with pytest.raises(botocore.exceptions.ClientError):
+    deliver(s3)
+  #XXX: With a single worker, the parts after the failed one are never started.
+  assert attempted == [1, 2, 3]
+  checkpoint = load_checkpoint(s3)
+  assert sorted(checkpoint['parts']) == ['1', '2']
+
+  attempted = intercept_parts(s3)
+  deliver(s3)
+  assert attempted == list(range(3, PART_COUNT + 1))
+  assert s3.objects[(DST_BUCKET, DST_KEY)]['Body'] == BODY
+  assert s3.calls['CreateMultipartUpload'] == 1
+
+
+def test_stale_checkpoint_aborts_old_upload(s3):
+  intercept_parts(s3, failures={3: 'InternalError'})
+  with pytest.raises(botocore.exceptions.ClientError):
+    deliver(s3)
+  stale_upload_id = load_checkpoint(s3)['upload_id']
+
+  new_body = BODY[::-1]
+  s3.store_object(SRC_BUCKET, SRC_KEY, new_body)
+  intercept_parts(s3)
+  deliver(s3)
+  assert stale_upload_id not in s3.uploads
+  assert s3.objects[(DST_BUCKET, DST_KEY)]['Body'] == new_body
+  assert s3.calls['CreateMultipartUpload'] == 2
+  assert load_checkpoint(s3) is None
+
+
+def test_no_such_upload_discards_checkpoint(s3):
+  intercept_parts(s3, failures={3: 'InternalError'})
+  with pytest.raises(botocore.exceptions.ClientError):
+    deliver(s3)
+  s3.abort_multipart_upload(Bucket=DST_BUCKET, Key=DST_KEY, UploadId=load_checkpoint(s3)['upload_id'])
+
+  intercept_parts(s3)
+  with pytest.raises(botocore.exceptions.ClientError) as exc_info:
+    deliver(s3)
+  assert exc_info.value.response['Error']['Code'] == 'NoSuchUpload'
+  assert load_checkpoint(s3) is None
+
+  deliver(s3)
+  assert s3.objects[(DST_BUCKET, DST_KEY)]['Body'] == BODY
+
+
+def test_source_moved_discards_checkpoint(s3):
+  def _move_source(part_number):
+    if part_number == 3:
+      #XXX: Another delivery of the same results moved the source object.
+      s3.objects.pop((SRC_BUCKET, SRC_KEY))
+  intercept_parts(s3, before=_move_source)
+  with pytest.raises(botocore.exceptions.ClientError) as exc_info:
+    deliver(s3, move=True)
+  assert exc_info.value.response['Error']['Code'] == 'NoSuchKey'
+  assert load_checkpoint(s3) is None
+  assert s3.uploads == {}
+
+
+def test_orphaned_query_results_are_not_delivered(monkeypatch):
+  backend = FakeBackend()
+  monkeypatch.setattr(aws_backends, '_BACKEND', backend)
+  monkeypatch.setattr(query_results_handler, 'DDB_TABLE_NAME', 'AthenaQueryStatusPerUser')
+  monkeypatch.setattr(query_results_handler, 'EMAIL_FROM_ADDRESS', 'sender@example.com')
+  monkeypatch.setattr(results_delivery, 'RESULTS_DELIVERY_TARGETS', {'@example.com': 's3://team-bucket/results/'})
+
+  athena = backend.athena_service
+  athena.failure_rate, athena.cancel_rate = 0.0, 0.0
+  response = athena.start_query_execution(QueryString='SELECT 1',
+    ResultConfiguration={'OutputLocation': 's3://{}/query-results/'.format(SRC_BUCKET)})
+  backend.clock.advance(athena.max_lifecycle_seconds() + 1)
+  query_execution = athena.get_query_execution(QueryExecutionId=response['QueryExecutionId'])['QueryExecution']
+
+  #XXX: No tracking row refers to the query, e.g. a newer query of the same user replaced it.
+  record = query_results_handler.complete_query(query_execution, 'test')
+  assert record['user_id'] is None
+  assert not any(bucket == 'team-bucket' for bucket, _ in backend.s3_service.objects)